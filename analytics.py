@@ -0,0 +1,170 @@
+import asyncio
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import UpdateOne
+from database import db
+
+# Số liệu thống kê được cập nhật dần khi dữ liệu tới, không tính lại lúc truy vấn:
+#
+# lamp_usage_daily: {roomId, date: "YYYY-MM-DD", onSeconds: {device1: s, ...}, totalOnSeconds}
+#   cộng dồn mỗi khi một đèn chuyển từ bật sang tắt (khoảng bật được chia theo ngày),
+#   đèn đang bật được API cộng thêm từ device_states.onSince lúc truy vấn
+# climate_daily: {roomId, floor, date, tempSum, tempCount, tempMin, tempMax, humSum, humCount}
+#   gom trong bộ nhớ và ghi theo lô mỗi CLIMATE_FLUSH_INTERVAL giây
+
+CLIMATE_FLUSH_INTERVAL = 10
+
+def day_key(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%d")
+
+# Chia khoảng [start, end) theo ngày: [(ngày, số giây), ...]
+def split_by_day(start: datetime, end: datetime):
+    parts = []
+    while start < end:
+        next_day = datetime(start.year, start.month, start.day) + timedelta(days=1)
+        stop = min(end, next_day)
+        parts.append((day_key(start), (stop - start).total_seconds()))
+        start = stop
+    return parts
+
+# Task ghi lamp_usage_daily đang chạy nền (giữ tham chiếu để task không bị GC, chờ khi tắt server)
+_pending_writes = set()
+
+# Ghi nhận các đèn vừa chuyển bật -> tắt, dựa trên state trước khi cập nhật.
+# Thống kê không nằm trên đường gửi lệnh / nhận message: tính đồng bộ, ghi DB ở task nền.
+def record_lamp_transitions(room_id: str, before: dict, changes: dict, now: datetime):
+    if not before or not room_id:
+        return
+
+    prev_lamps = before.get("lamps") or {}
+    on_since = before.get("onSince") or {}
+    inc_by_day = {}
+
+    for key, val in changes.items():
+        started = on_since.get(key)
+        if prev_lamps.get(key) and not val and started:
+            for date, seconds in split_by_day(started, now):
+                inc = inc_by_day.setdefault(date, {"totalOnSeconds": 0})
+                inc[f"onSeconds.{key}"] = inc.get(f"onSeconds.{key}", 0) + seconds
+                inc["totalOnSeconds"] += seconds
+
+    if inc_by_day:
+        task = asyncio.create_task(_write_lamp_usage(room_id, inc_by_day))
+        _pending_writes.add(task)
+        task.add_done_callback(_pending_writes.discard)
+
+async def _write_lamp_usage(room_id: str, inc_by_day: dict):
+    try:
+        await db.lamp_usage_daily.bulk_write([
+            UpdateOne({"roomId": room_id, "date": date}, {"$inc": inc}, upsert=True)
+            for date, inc in inc_by_day.items()
+        ], ordered=False)
+    except Exception as e:
+        print(f"[ANALYTICS] Lỗi ghi lamp_usage_daily phòng {room_id}: {e}")
+
+async def wait_pending_writes():
+    if _pending_writes:
+        await asyncio.gather(*_pending_writes, return_exceptions=True)
+
+# Gom số liệu cảm biến theo (phòng, ngày) rồi ghi định kỳ
+class ClimateAggregator:
+    def __init__(self):
+        self._buffer = {}
+        self._task = None
+
+    def add(self, room_id: str, data: dict, now: datetime):
+        temperature = data.get("temperature")
+        humidity = data.get("humidity")
+        key = (room_id, day_key(now))
+        acc = self._buffer.get(key)
+        if acc is None:
+            acc = self._buffer[key] = {
+                "tempSum": 0.0, "tempCount": 0, "tempMin": None, "tempMax": None,
+                "humSum": 0.0, "humCount": 0
+            }
+        if isinstance(temperature, (int, float)):
+            acc["tempSum"] += temperature
+            acc["tempCount"] += 1
+            if acc["tempMin"] is None or temperature < acc["tempMin"]:
+                acc["tempMin"] = temperature
+            if acc["tempMax"] is None or temperature > acc["tempMax"]:
+                acc["tempMax"] = temperature
+        if isinstance(humidity, (int, float)):
+            acc["humSum"] += humidity
+            acc["humCount"] += 1
+
+    # Trả lô chưa ghi được về buffer (gộp với số liệu mới tới trong lúc ghi) để lần sau thử lại
+    def _restore(self, buffer: dict):
+        for key, acc in buffer.items():
+            current = self._buffer.get(key)
+            if current is None:
+                self._buffer[key] = acc
+                continue
+            for field in ("tempSum", "tempCount", "humSum", "humCount"):
+                current[field] += acc[field]
+            if acc["tempMin"] is not None and (current["tempMin"] is None or acc["tempMin"] < current["tempMin"]):
+                current["tempMin"] = acc["tempMin"]
+            if acc["tempMax"] is not None and (current["tempMax"] is None or acc["tempMax"] > current["tempMax"]):
+                current["tempMax"] = acc["tempMax"]
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        buffer, self._buffer = self._buffer, {}
+
+        try:
+            # Lấy tầng của các phòng trong lô (một truy vấn)
+            room_ids = {room_id for room_id, _ in buffer}
+            object_ids = [ObjectId(room_id) for room_id in room_ids if ObjectId.is_valid(room_id)]
+            rooms = await db.rooms.find({"_id": {"$in": object_ids}}, {"floor": 1}).to_list(length=None)
+            floors = {str(room["_id"]): room.get("floor") for room in rooms}
+
+            ops = []
+            for (room_id, date), acc in buffer.items():
+                update = {
+                    "$inc": {
+                        "tempSum": acc["tempSum"], "tempCount": acc["tempCount"],
+                        "humSum": acc["humSum"], "humCount": acc["humCount"]
+                    },
+                    "$set": {"floor": floors.get(room_id)}
+                }
+                if acc["tempCount"]:
+                    update["$min"] = {"tempMin": acc["tempMin"]}
+                    update["$max"] = {"tempMax": acc["tempMax"]}
+                ops.append(UpdateOne({"roomId": room_id, "date": date}, update, upsert=True))
+
+            await db.climate_daily.bulk_write(ops, ordered=False)
+        except Exception as e:
+            # bulk_write không theo thứ tự có thể đã ghi một phần -> chấp nhận đếm trùng thay vì mất số liệu
+            self._restore(buffer)
+            print(f"[ANALYTICS] Lỗi ghi climate_daily, thử lại sau: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(CLIMATE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[ANALYTICS] Lỗi flush climate: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+climate_aggregator = ClimateAggregator()
+
+async def ensure_indexes():
+    await db.lamp_usage_daily.create_index([("roomId", 1), ("date", 1)], unique=True)
+    await db.lamp_usage_daily.create_index("date")
+    await db.climate_daily.create_index([("roomId", 1), ("date", 1)], unique=True)
+    await db.climate_daily.create_index([("date", 1), ("floor", 1)])
@@ -0,0 +1,334 @@
+import asyncio
+import bisect
+import operator
+import time
+from datetime import datetime
+from bson import ObjectId
+from database import db
+from command_service import send_lamp_command, LAMP_ENDPOINT_IDS
+from ratelimit import get_command_limiter
+
+OPERATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+MESSAGE_TRIGGERS = ("status", "device")
+
+# Toán tử so sánh được với ngưỡng đã sắp xếp (tập rule thỏa là một đoạn liên tiếp)
+RANGE_OPERATORS = (operator.gt, operator.ge, operator.lt, operator.le, operator.eq)
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and value == value
+
+# Rule đã biên dịch: chỉ giữ những gì cần cho việc so khớp
+class CompiledRule:
+    __slots__ = ("rule_id", "name", "room_id", "field", "op", "value", "at", "days", "action", "active_rooms")
+
+    def __init__(self, rule_id, name, room_id, field, op, value, at, days, action):
+        self.rule_id = rule_id
+        self.name = name
+        self.room_id = room_id
+        self.field = field
+        self.op = op
+        self.value = value
+        self.at = at
+        self.days = days
+        self.action = action
+        # Các phòng đang thỏa điều kiện -> chỉ kích hoạt khi chuyển từ sai sang đúng
+        self.active_rooms = set()
+
+# Kiểm tra và biên dịch rule, ném ValueError nếu rule không hợp lệ
+def compile_rule(rule: dict) -> CompiledRule:
+    trigger = rule.get("trigger") or {}
+    action = rule.get("action") or {}
+    trigger_type = trigger.get("type")
+
+    if action.get("command") not in ("TURN_ON", "TURN_OFF"):
+        raise ValueError("action.command phải là TURN_ON hoặc TURN_OFF")
+    endpoint_id = action.get("endpointId")
+    if endpoint_id is not None and endpoint_id not in LAMP_ENDPOINT_IDS:
+        raise ValueError("action.endpointId phải từ 1 đến 3 (chỉ điều khiển đèn)")
+
+    if trigger_type in MESSAGE_TRIGGERS:
+        op = OPERATORS.get(trigger.get("op"))
+        if op is None:
+            raise ValueError(f"trigger.op phải là một trong {list(OPERATORS)}")
+        if not trigger.get("field") or trigger.get("value") is None:
+            raise ValueError("trigger cần field và value")
+        return CompiledRule(
+            str(rule.get("_id")), rule.get("name"), rule.get("roomId"),
+            trigger["field"], op, trigger["value"], None, None, action
+        )
+
+    if trigger_type == "schedule":
+        at = trigger.get("at") or ""
+        try:
+            at = datetime.strptime(at, "%H:%M").strftime("%H:%M")
+        except ValueError:
+            raise ValueError("trigger.at phải có dạng HH:MM")
+        if not (action.get("deviceId") or action.get("roomId") or action.get("floor") is not None or rule.get("roomId")):
+            raise ValueError("Rule theo giờ cần chỉ định deviceId, roomId hoặc floor")
+        days = trigger.get("days")
+        return CompiledRule(
+            str(rule.get("_id")), rule.get("name"), rule.get("roomId"),
+            None, None, None, at, frozenset(days) if days else None, action
+        )
+
+    raise ValueError("trigger.type phải là status, device hoặc schedule")
+
+# Các rule cùng field + toán tử, sắp xếp theo ngưỡng: tìm đoạn rule thỏa bằng bisect.
+# Mỗi phòng nhớ đoạn thỏa lần trước -> chỉ duyệt các rule đổi trạng thái (vào / ra khỏi đoạn).
+class ThresholdGroup:
+    __slots__ = ("field", "op", "rules", "values", "ranges")
+
+    def __init__(self, field, op, rules):
+        self.field = field
+        self.op = op
+        self.rules = sorted(rules, key=lambda rule: rule.value)
+        self.values = [rule.value for rule in self.rules]
+        # roomId -> (lo, hi) đoạn rule thỏa ở lần đánh giá trước
+        self.ranges = {}
+
+    def hit_range(self, val):
+        if not is_number(val):
+            return 0, 0
+        op = self.op
+        if op is operator.gt:
+            return 0, bisect.bisect_left(self.values, val)
+        if op is operator.ge:
+            return 0, bisect.bisect_right(self.values, val)
+        if op is operator.lt:
+            return bisect.bisect_right(self.values, val), len(self.values)
+        if op is operator.le:
+            return bisect.bisect_left(self.values, val), len(self.values)
+        return bisect.bisect_left(self.values, val), bisect.bisect_right(self.values, val)
+
+    def evaluate(self, room_id, val, matched):
+        lo, hi = self.hit_range(val)
+        rules = self.rules
+        prev = self.ranges.get(room_id)
+        if prev is None:
+            # Lần đầu gặp phòng này (hoặc vừa nạp lại rule): đồng bộ active_rooms của cả nhóm
+            for i, rule in enumerate(rules):
+                if lo <= i < hi:
+                    if room_id not in rule.active_rooms:
+                        rule.active_rooms.add(room_id)
+                        matched.append(rule)
+                else:
+                    rule.active_rooms.discard(room_id)
+        else:
+            prev_lo, prev_hi = prev
+            for i in (*range(lo, min(hi, prev_lo)), *range(max(lo, prev_hi), hi)):
+                rule = rules[i]
+                if room_id not in rule.active_rooms:
+                    rule.active_rooms.add(room_id)
+                    matched.append(rule)
+            for i in (*range(prev_lo, min(prev_hi, lo)), *range(max(prev_lo, hi), prev_hi)):
+                rules[i].active_rooms.discard(room_id)
+        self.ranges[room_id] = (lo, hi)
+
+# Rule của một (roomId | None, loại topic): nhóm theo ngưỡng nếu được, còn lại duyệt tuần tự
+class RuleSet:
+    __slots__ = ("rules", "linear", "groups")
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.linear = []
+        by_key = {}
+        for rule in rules:
+            if rule.op in RANGE_OPERATORS and is_number(rule.value):
+                by_key.setdefault((rule.field, rule.op), []).append(rule)
+            else:
+                self.linear.append(rule)
+        self.groups = [ThresholdGroup(field, op, group) for (field, op), group in by_key.items()]
+
+    def evaluate(self, room_id, data: dict, matched):
+        for rule in self.linear:
+            val = data.get(rule.field)
+            try:
+                hit = val is not None and rule.op(val, rule.value)
+            except TypeError:
+                hit = False
+            if hit:
+                if room_id not in rule.active_rooms:
+                    rule.active_rooms.add(room_id)
+                    matched.append(rule)
+            else:
+                rule.active_rooms.discard(room_id)
+        for group in self.groups:
+            group.evaluate(room_id, data.get(group.field), matched)
+
+class RuleEngine:
+    def __init__(self):
+        # (roomId | None, loại topic) -> RuleSet các rule có thể khớp
+        self._index = {}
+        # "HH:MM" -> danh sách rule theo giờ
+        self._schedule = {}
+        self._scheduler_task = None
+        self._tasks = set()
+        self.rule_count = 0
+        self.evaluations = 0
+        self.matches = 0
+        self.eval_ns_total = 0
+        self.eval_ns_max = 0
+        self.actions_ok = 0
+        self.actions_failed = 0
+        self.actions_rate_limited = 0
+
+    def load(self, rules):
+        # Giữ trạng thái "đang thỏa" của rule cũ để rule không kích hoạt lại sau khi nạp lại
+        previous = {
+            rule.rule_id: rule.active_rooms
+            for rule_set in self._index.values()
+            for rule in rule_set.rules
+        }
+
+        index = {}
+        schedule = {}
+        count = 0
+        for rule in rules:
+            try:
+                compiled = compile_rule(rule)
+            except ValueError as e:
+                print(f"[RULES] Bỏ qua rule {rule.get('_id')}: {e}")
+                continue
+            if compiled.rule_id in previous:
+                compiled.active_rooms = previous[compiled.rule_id]
+            if compiled.at is not None:
+                schedule.setdefault(compiled.at, []).append(compiled)
+            else:
+                key = (compiled.room_id, rule["trigger"]["type"])
+                index.setdefault(key, []).append(compiled)
+            count += 1
+
+        # Thay thế nguyên khối để không cần khóa
+        self._index = {key: RuleSet(rules_by_key) for key, rules_by_key in index.items()}
+        self._schedule = schedule
+        self.rule_count = count
+
+    async def reload(self):
+        rules = await db.rules.find({"enabled": True}).to_list(length=None)
+        self.load(rules)
+        print(f"[RULES] Đã nạp {self.rule_count} rule")
+
+    # So khớp một message MQTT, chỉ với các rule của đúng phòng + loại topic
+    def evaluate(self, room_id: str, type_msg: str, data):
+        start = time.perf_counter_ns()
+        matched = []
+        if isinstance(data, dict):
+            for key in ((room_id, type_msg), (None, type_msg)):
+                rule_set = self._index.get(key)
+                if rule_set is not None:
+                    rule_set.evaluate(room_id, data, matched)
+
+        elapsed = time.perf_counter_ns() - start
+        self.evaluations += 1
+        self.matches += len(matched)
+        self.eval_ns_total += elapsed
+        if elapsed > self.eval_ns_max:
+            self.eval_ns_max = elapsed
+        return matched
+
+    # Gọi trực tiếp từ handler MQTT: so khớp đồng bộ, hành động chạy nền
+    def on_message(self, room_id: str, type_msg: str, data):
+        if not self._index:
+            return
+        for rule in self.evaluate(room_id, type_msg, data):
+            self._spawn(rule, room_id)
+
+    def _spawn(self, rule: CompiledRule, room_id):
+        task = asyncio.create_task(self.execute_action(rule, room_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _resolve_devices(self, action: dict, room_id):
+        if action.get("deviceId"):
+            device = await db.devices.find_one({"_id": ObjectId(action["deviceId"])}, {"roomId": 1})
+            return [device] if device else []
+        if action.get("roomId"):
+            return await db.devices.find({"roomId": action["roomId"]}, {"roomId": 1}).to_list(length=None)
+        if action.get("floor") is not None:
+            rooms = await db.rooms.find({"floor": action["floor"]}, {"_id": 1}).to_list(length=None)
+            room_ids = [str(room["_id"]) for room in rooms]
+            return await db.devices.find({"roomId": {"$in": room_ids}}, {"roomId": 1}).to_list(length=None)
+        if room_id:
+            return await db.devices.find({"roomId": room_id}, {"roomId": 1}).to_list(length=None)
+        return []
+
+    async def execute_action(self, rule: CompiledRule, room_id):
+        action = rule.action
+        endpoint_ids = [action["endpointId"]] if action.get("endpointId") else list(LAMP_ENDPOINT_IDS)
+        try:
+            devices = await self._resolve_devices(action, room_id)
+        except Exception as e:
+            self.actions_failed += 1
+            print(f"[RULES] Lỗi thực thi rule {rule.name}: {e}")
+            return
+
+        limiter = get_command_limiter()
+        failed = 0
+        for device in devices:
+            # Thiết bị bị giới hạn tần suất chỉ bị bỏ qua, các thiết bị còn lại vẫn nhận lệnh
+            rejected = limiter.try_acquire(device_id=str(device["_id"]), room_id=device.get("roomId"))
+            if rejected:
+                self.actions_rate_limited += 1
+                print(f"[RULES] Rule {rule.name}: bỏ qua thiết bị {device['_id']} (giới hạn {rejected[0]})")
+                continue
+            try:
+                await send_lamp_command(device, endpoint_ids, action["command"], source=f"RULE {rule.name}")
+            except Exception as e:
+                failed += 1
+                print(f"[RULES] Lỗi thực thi rule {rule.name} cho thiết bị {device['_id']}: {e}")
+
+        if failed:
+            self.actions_failed += 1
+        else:
+            self.actions_ok += 1
+
+    def start_scheduler(self):
+        if self._scheduler_task is None:
+            self._scheduler_task = asyncio.create_task(self._run_scheduler())
+
+    async def stop_scheduler(self):
+        if self._scheduler_task is not None:
+            self._scheduler_task.cancel()
+            try:
+                await self._scheduler_task
+            except asyncio.CancelledError:
+                pass
+            self._scheduler_task = None
+
+    async def _run_scheduler(self):
+        last_minute = None
+        while True:
+            now = datetime.now()
+            # Ngủ tới đầu phút kế tiếp (cộng thêm chút để không dậy sớm)
+            await asyncio.sleep(60 - now.second - now.microsecond / 1_000_000 + 0.05)
+            now = datetime.now()
+            minute = now.strftime("%H:%M")
+            if minute == last_minute:
+                continue
+            last_minute = minute
+            for rule in self._schedule.get(minute, ()):
+                if rule.days is None or now.weekday() in rule.days:
+                    self._spawn(rule, rule.room_id)
+
+    def metrics(self):
+        return {
+            "rules": self.rule_count,
+            "evaluations": self.evaluations,
+            "matches": self.matches,
+            "avg_eval_us": round(self.eval_ns_total / self.evaluations / 1000, 3) if self.evaluations else 0.0,
+            "max_eval_us": round(self.eval_ns_max / 1000, 3),
+            "actions_ok": self.actions_ok,
+            "actions_failed": self.actions_failed,
+            "actions_rate_limited": self.actions_rate_limited,
+            "pending_actions": len(self._tasks),
+        }
+
+rule_engine = RuleEngine()
@@ -0,0 +1,67 @@
+import gzip
+import struct
+import time
+
+# File capture nhị phân: header + các bản ghi (timestamp, topic, payload)
+#   record = <d: timestamp><H: độ dài topic><I: độ dài payload><topic><payload>
+# File có đuôi .gz sẽ được nén gzip.
+MAGIC = b"SHCAP1\n"
+RECORD_HEADER = struct.Struct("<dHI")
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode, buffering=1024 * 1024)
+
+# Ghi lại message MQTT đi vào on_message
+class MessageCapture:
+    def __init__(self):
+        self.path = None
+        self.count = 0
+        self._file = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None
+
+    def start(self, path: str):
+        if self._file is not None:
+            self.stop()
+        self._file = _open(path, "wb")
+        self._file.write(MAGIC)
+        self.path = path
+        self.count = 0
+        print(f"[CAPTURE] Ghi message MQTT vào {path}")
+
+    def record(self, topic: str, payload: bytes, ts: float = None):
+        topic_bytes = topic.encode()
+        self._file.write(RECORD_HEADER.pack(ts or time.time(), len(topic_bytes), len(payload)))
+        self._file.write(topic_bytes)
+        self._file.write(payload)
+        self.count += 1
+
+    def stop(self):
+        file, self._file = self._file, None
+        if file is None:
+            return
+        try:
+            file.close()
+            print(f"[CAPTURE] Đã ghi {self.count} message vào {self.path}")
+        except Exception as e:
+            print(f"[CAPTURE] Lỗi đóng file capture {self.path}: {e}")
+
+# Đọc lần lượt các bản ghi (timestamp, topic, payload) từ file capture
+def read_capture(path: str):
+    with _open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} không phải file capture hợp lệ")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            ts, topic_len, payload_len = RECORD_HEADER.unpack(header)
+            topic = f.read(topic_len).decode()
+            payload = f.read(payload_len)
+            yield ts, topic, payload
+
+capture = MessageCapture()
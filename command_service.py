@@ -0,0 +1,91 @@
+from fastapi import HTTPException
+from database import db
+from models import Command
+from datetime import datetime
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from device_state import new_state, update_lamps
+from ratelimit import get_command_limiter
+from singleflight import get_read_coalescer
+from mqtt_client import mqtt, is_connected
+import json
+
+LAMP_ENDPOINT_IDS = (1, 2, 3)
+
+# Đường gửi lệnh chung: dùng cho API /devices/{id}/command, /commands/ và rule engine
+async def send_lamp_command(device: dict, endpoint_ids, command: str, payload=None, source: str = "DEVICE CMD"):
+    # Giới hạn tổng số lệnh đang xử lý cùng lúc (trả 429 khi quá tải)
+    limiter = get_command_limiter()
+    limiter.acquire_in_flight()
+    try:
+        return await _send_lamp_command(device, endpoint_ids, command, payload, source)
+    finally:
+        limiter.release_in_flight()
+
+async def _send_lamp_command(device: dict, endpoint_ids, command: str, payload, source: str):
+    device_id = str(device["_id"])
+    device_obj_id = device["_id"]
+    now = datetime.now()
+
+    new_commands = [
+        Command(
+            commandId=str(ObjectId()),
+            deviceId=device_id,
+            endpointId=endpoint_id,
+            command=command,
+            payload=payload,
+            status="PENDING",
+            createdAt=now
+        ).model_dump(by_alias=True, exclude=["id"])
+        for endpoint_id in endpoint_ids
+    ]
+
+    if len(new_commands) == 1:
+        await db.commands.insert_one(new_commands[0])
+    else:
+        await db.commands.insert_many(new_commands)
+
+    room_id = device.get("roomId")
+    if not room_id:
+        raise HTTPException(status_code=400, detail="Thiết bị chưa được gán vào phòng")
+
+    # Kiểm tra MQTT connection trước khi ghi state: không publish được thì state (và thống kê bật/tắt) giữ nguyên
+    if not is_connected():
+        print("[ERROR] MQTT client not connected!")
+        raise HTTPException(status_code=503, detail="MQTT broker không kết nối")
+
+    target_val = 1 if command == "TURN_ON" else 0
+
+    # === CẬP NHẬT STATE DOCUMENT (một lệnh, trả về trạng thái cũ) ===
+    changes = {f"device{endpoint_id}": target_val for endpoint_id in endpoint_ids}
+    before = await update_lamps({"_id": device_obj_id}, changes, now)
+
+    # Thiết bị chưa có state (chưa chạy migration) -> tạo mới rồi cập nhật lại
+    if before is None:
+        try:
+            await db.device_states.insert_one(new_state(device_obj_id, room_id, now))
+        except DuplicateKeyError:
+            pass
+        before = await update_lamps({"_id": device_obj_id}, changes, now)
+
+    lamp_states = {**(before.get("lamps") or {}), **changes}
+    get_read_coalescer().invalidate(f"device:{device_id}", f"room-devices:{room_id}")
+
+    mqtt_payload = {
+        "device1": lamp_states.get("device1", 0),
+        "device2": lamp_states.get("device2", 0),
+        "device3": lamp_states.get("device3", 0),
+    }
+
+    topic = f"{room_id}/device"
+    payload_json = json.dumps(mqtt_payload)
+
+    # Publish với QoS=1 để đảm bảo ESP nhận được
+    mqtt.publish(topic, payload_json, qos=1)
+    print(f"[{source}] Published to {topic}: {payload_json}")
+
+    return {
+        "commandIds": [cmd["commandId"] for cmd in new_commands],
+        "mqtt_topic": topic,
+        "payload": mqtt_payload
+    }
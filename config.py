@@ -0,0 +1,63 @@
+import os
+from functools import lru_cache
+from urllib.parse import quote_plus
+from dotenv import load_dotenv
+
+# Xử lý URL encode cho username/password nếu cần
+def encode_mongo_url(mongo_url):
+    if mongo_url and "@" in mongo_url and "://" in mongo_url:
+        try:
+            protocol, rest = mongo_url.split("://", 1)
+            if "@" in rest:
+                auth_part, host_part = rest.split("@", 1)
+                if ":" in auth_part:
+                    username, password = auth_part.split(":", 1)
+                    username_encoded = quote_plus(username)
+                    password_encoded = quote_plus(password)
+                    mongo_url = f"{protocol}://{username_encoded}:{password_encoded}@{host_part}"
+        except:
+            pass  # Sử dụng URL gốc nếu parse lỗi
+    return mongo_url
+
+# Cấu hình đọc từ biến môi trường / file .env (chỉ đọc một lần, khi cần tới)
+class Settings:
+    def __init__(self):
+        load_dotenv()
+
+        self.mongo_url = encode_mongo_url(os.getenv("MONGO_URL"))
+        self.db_name = os.getenv("DB_NAME") or "smart_home_db"
+        self.mongo_timeout_ms = int(os.getenv("MONGO_TIMEOUT_MS") or 5000)
+
+        self.mqtt_host = os.getenv("MQTT_HOST") or "localhost"
+        self.mqtt_port = int(os.getenv("MQTT_PORT") or 8883)
+        self.mqtt_user = os.getenv("MQTT_USER") or None
+        self.mqtt_password = os.getenv("MQTT_PASSWORD") or None
+        self.mqtt_tls = (os.getenv("MQTT_TLS") or "true").lower() not in ("0", "false", "no")
+
+        # Chu kỳ làm mới trạng thái /ready (giây)
+        self.ready_interval = float(os.getenv("READY_INTERVAL") or 5)
+
+        # Giới hạn lệnh điều khiển (lệnh/giây và số lệnh dồn tối đa)
+        self.cmd_rate_device = float(os.getenv("CMD_RATE_DEVICE") or 5)
+        self.cmd_burst_device = float(os.getenv("CMD_BURST_DEVICE") or 10)
+        self.cmd_rate_room = float(os.getenv("CMD_RATE_ROOM") or 10)
+        self.cmd_burst_room = float(os.getenv("CMD_BURST_ROOM") or 20)
+        self.cmd_rate_client = float(os.getenv("CMD_RATE_CLIENT") or 20)
+        self.cmd_burst_client = float(os.getenv("CMD_BURST_CLIENT") or 40)
+        self.cmd_max_in_flight = int(os.getenv("CMD_MAX_IN_FLIGHT") or 100)
+        # API key hợp lệ (phân tách bằng dấu phẩy), chỉ các key này được tính giới hạn riêng
+        self.api_keys = frozenset(key.strip() for key in (os.getenv("API_KEYS") or "").split(",") if key.strip())
+
+        # Ghi lại message MQTT vào file (để replay), để trống = tắt
+        self.mqtt_capture_path = os.getenv("MQTT_CAPTURE_PATH") or None
+
+        # Lệnh MongoDB chậm hơn ngưỡng này (ms) sẽ được log + lưu lại
+        self.slow_op_ms = float(os.getenv("SLOW_OP_MS") or 100)
+        self.slow_op_buffer = int(os.getenv("SLOW_OP_BUFFER") or 1000)
+
+        # Giữ kết quả đọc device/room thêm vài chục ms (0 = chỉ gộp request đồng thời)
+        self.read_cache_ttl_ms = float(os.getenv("READ_CACHE_TTL_MS") or 50)
+
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()
@@ -1,30 +1,50 @@
-import os
 from motor.motor_asyncio import AsyncIOMotorClient
-from dotenv import load_dotenv
-from urllib.parse import quote_plus
-
-# Đọc các biến từ file .env
-load_dotenv()
-
-MONGO_URL = os.getenv("MONGO_URL")
-DB_NAME = os.getenv("DB_NAME")
-
-# Xử lý URL encode cho username/password nếu cần
-if MONGO_URL and "@" in MONGO_URL and "://" in MONGO_URL:
-    try:
-        protocol, rest = MONGO_URL.split("://", 1)
-        if "@" in rest:
-            auth_part, host_part = rest.split("@", 1)
-            if ":" in auth_part:
-                username, password = auth_part.split(":", 1)
-                username_encoded = quote_plus(username)
-                password_encoded = quote_plus(password)
-                MONGO_URL = f"{protocol}://{username_encoded}:{password_encoded}@{host_part}"
-    except:
-        pass  # Sử dụng URL gốc nếu parse lỗi
-
-# Tạo kết nối
-client = AsyncIOMotorClient(MONGO_URL)
-db = client[DB_NAME]
-
-print(f"Kết nối tới MongoDB: {DB_NAME}")
\ No newline at end of file
+from config import get_settings
+
+_client = None
+_db = None
+_listeners = []
+
+# Đăng ký pymongo CommandListener (phải gọi trước khi client được tạo)
+def register_listener(listener):
+    if listener in _listeners:
+        return
+    if _client is not None:
+        raise RuntimeError("MongoDB client đã được tạo, không thể thêm listener")
+    _listeners.append(listener)
+
+# Tạo kết nối khi cần tới lần đầu (không tạo lúc import)
+def get_client() -> AsyncIOMotorClient:
+    global _client
+    if _client is None:
+        settings = get_settings()
+        _client = AsyncIOMotorClient(
+            settings.mongo_url,
+            serverSelectionTimeoutMS=settings.mongo_timeout_ms,
+            event_listeners=list(_listeners)
+        )
+        print(f"Kết nối tới MongoDB: {settings.db_name}")
+    return _client
+
+def get_db():
+    global _db
+    if _db is None:
+        _db = get_client()[get_settings().db_name]
+    return _db
+
+def close_client():
+    global _client, _db
+    if _client is not None:
+        _client.close()
+    _client = None
+    _db = None
+
+# Cho phép các module dùng `db.devices...` như cũ, client chỉ được tạo khi truy cập
+class _LazyDatabase:
+    def __getattr__(self, name):
+        return getattr(get_db(), name)
+
+    def __getitem__(self, name):
+        return get_db()[name]
+
+db = _LazyDatabase()
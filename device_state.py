@@ -0,0 +1,120 @@
+from database import db
+from datetime import datetime
+from pymongo import ReturnDocument
+from analytics import record_lamp_transitions
+
+# Trạng thái "nóng" của thiết bị được tách khỏi document Device vào collection
+# device_states (cùng _id với device). Document có hình dạng cố định và nhỏ nên
+# mỗi message ingest / lệnh điều khiển chỉ ghi vài field, không đụng tới
+# mảng endpoints.
+#
+# {
+#     "_id": <ObjectId của device>,
+#     "roomId": "...",
+#     "lamps": {"device1": 0, "device2": 0, "device3": 0},
+#     "sensor": {"temperature": 0.0, "humidity": 0.0},
+#     "updatedAt": {"1": dt, "2": dt, "3": dt, "4": dt},  # theo endpoint id
+#     "onSince": {"device1": dt | None, ...},  # thời điểm đèn được bật (cho thống kê)
+#     "isOnline": False,
+#     "lastSeenAt": None
+# }
+
+SENSOR_ENDPOINT_ID = 4
+LAMP_KEYS = ("device1", "device2", "device3")
+
+def new_state(device_id, room_id: str, now: datetime = None, lamps: dict = None, sensor: dict = None,
+              is_online: bool = False, last_seen_at: datetime = None) -> dict:
+    now = now or datetime.now()
+    lamps = {
+        "device1": 0, "device2": 0, "device3": 0,
+        **(lamps or {})
+    }
+    return {
+        "_id": device_id,
+        "roomId": room_id,
+        "lamps": lamps,
+        "sensor": {
+            "temperature": 0.0, "humidity": 0.0,
+            **(sensor or {})
+        },
+        "updatedAt": {"1": now, "2": now, "3": now, "4": now},
+        "onSince": {key: now if val else None for key, val in lamps.items()},
+        "isOnline": is_online,
+        "lastSeenAt": last_seen_at
+    }
+
+# Cập nhật trạng thái đèn trong một lệnh ghi (update pipeline):
+# onSince chỉ đổi khi đèn chuyển trạng thái, state cũ được trả về để ghi nhận thống kê.
+# changes: {"device1": 1, ...}, extra: các field khác cần $set
+async def update_lamps(filter: dict, changes: dict, now: datetime, extra: dict = None):
+    fields = {}
+    for key, val in changes.items():
+        fields[f"updatedAt.{key.replace('device', '')}"] = now
+        if val:
+            # Giữ onSince nếu đèn đã bật từ trước, ngược lại bắt đầu tính từ bây giờ
+            fields[f"onSince.{key}"] = {"$ifNull": [{"$cond": [f"$lamps.{key}", f"$onSince.{key}", None]}, now]}
+        else:
+            fields[f"onSince.{key}"] = None
+    for key, val in (extra or {}).items():
+        fields[key] = {"$literal": val}
+
+    lamp_fields = {f"lamps.{key}": {"$literal": val} for key, val in changes.items()}
+
+    before = await db.device_states.find_one_and_update(
+        filter,
+        [{"$set": fields}, {"$set": lamp_fields}],
+        projection={"roomId": 1, "lamps": 1, "onSince": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    if before is not None:
+        record_lamp_transitions(before.get("roomId"), before, changes, now)
+    return before
+
+# Ghép state vào device để API trả về đúng định dạng cũ
+def merge_state(device: dict, state: dict) -> dict:
+    if not state:
+        return device
+
+    lamps = state.get("lamps", {})
+    sensor = state.get("sensor", {})
+    updated_at = state.get("updatedAt", {})
+
+    device["currentLampStates"] = lamps
+    device["currentSensorData"] = sensor
+    device["isOnline"] = state.get("isOnline", False)
+    device["lastSeenAt"] = state.get("lastSeenAt")
+
+    for ep in device.get("endpoints", []):
+        ep_id = ep.get("id")
+        if ep_id == SENSOR_ENDPOINT_ID:
+            ep["value"] = sensor
+        else:
+            ep["value"] = lamps.get(f"device{ep_id}", 0)
+        if updated_at.get(str(ep_id)) is not None:
+            ep["lastUpdated"] = updated_at[str(ep_id)]
+
+    return device
+
+async def attach_state(device: dict) -> dict:
+    state = await db.device_states.find_one({"_id": device["_id"]})
+    return merge_state(device, state)
+
+# Lấy state của nhiều device bằng một truy vấn $in
+async def attach_states(devices: list) -> list:
+    if not devices:
+        return devices
+    states = await db.device_states.find(
+        {"_id": {"$in": [device["_id"] for device in devices]}}
+    ).to_list(length=None)
+    by_id = {state["_id"]: state for state in states}
+    return [merge_state(device, by_id.get(device["_id"])) for device in devices]
+
+async def ensure_indexes():
+    await db.devices.create_index("roomId")
+    await db.device_states.create_index("roomId")
+    # Index riêng phần chỉ chứa đèn đang bật -> tìm khoảng bật chưa kết thúc mà không quét cả collection
+    for key in LAMP_KEYS:
+        await db.device_states.create_index(
+            f"onSince.{key}",
+            partialFilterExpression={f"onSince.{key}": {"$type": "date"}}
+        )
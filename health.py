@@ -0,0 +1,68 @@
+import asyncio
+import time
+from datetime import datetime
+from database import get_client
+import mqtt_client
+
+# Trạng thái sẵn sàng được làm mới định kỳ ở nền, /ready chỉ đọc kết quả đã cache
+class ReadinessProbe:
+    def __init__(self):
+        self.mongo_ok = False
+        self.mongo_latency_ms = None
+        self.mongo_error = None
+        self.mqtt_ok = False
+        self.warmed_up = False
+        self.checked_at = None
+        self._task = None
+
+    async def check(self, timeout: float = 2.0):
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(get_client().admin.command("ping"), timeout)
+            self.mongo_ok = True
+            self.mongo_error = None
+            self.mongo_latency_ms = round((time.perf_counter() - start) * 1000, 2)
+        except Exception as e:
+            self.mongo_ok = False
+            self.mongo_error = str(e) or type(e).__name__
+            self.mongo_latency_ms = None
+
+        self.mqtt_ok = mqtt_client.is_connected()
+        self.checked_at = datetime.now()
+
+    async def _run(self, interval: float):
+        while True:
+            await self.check(timeout=min(interval, 2.0))
+            await asyncio.sleep(interval)
+
+    def start(self, interval: float):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @property
+    def ready(self) -> bool:
+        return self.mongo_ok and self.mqtt_ok and self.warmed_up
+
+    def snapshot(self) -> dict:
+        return {
+            "ready": self.ready,
+            "mongo": {
+                "ok": self.mongo_ok,
+                "latency_ms": self.mongo_latency_ms,
+                "error": self.mongo_error
+            },
+            "mqtt": {"ok": self.mqtt_ok},
+            "warmed_up": self.warmed_up,
+            "checkedAt": self.checked_at.isoformat() if self.checked_at else None
+        }
+
+readiness = ReadinessProbe()
@@ -1,22 +1,78 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 import asyncio
-from database import db
-from routers import rooms, devices, commands
-from mqtt_client import mqtt
+from database import db, close_client, register_listener
+from routers import rooms, devices, commands, rules, admin, analytics
+from automation import rule_engine
+from device_state import SENSOR_ENDPOINT_ID, ensure_indexes, update_lamps
+from analytics import climate_aggregator, wait_pending_writes, ensure_indexes as ensure_analytics_indexes
+from mqtt_client import get_mqtt, configure_logging
+import mqtt_client
+from config import get_settings
+from health import readiness
+from capture import capture
+from tracing import get_tracer, correlation_id, new_request_id, new_message_id
 from datetime import datetime
 import json
 
+STARTUP_RETRY_DELAY = 5
+
+# Kết nối MQTT ở nền (thử lại nếu broker chưa sẵn sàng) để server nhận request ngay
+async def start_mqtt():
+    mqtt = get_mqtt()
+    mqtt.on_connect()(connect)
+    mqtt.on_message()(message)
+    while True:
+        try:
+            await mqtt.mqtt_startup()
+            return
+        except Exception as e:
+            print(f"[STARTUP] Lỗi kết nối MQTT: {e}, thử lại sau {STARTUP_RETRY_DELAY}s")
+            await asyncio.sleep(STARTUP_RETRY_DELAY)
+
+# Tạo index + nạp rule ở nền
+async def prepare_db():
+    while True:
+        try:
+            await ensure_indexes()
+            await ensure_analytics_indexes()
+            await rule_engine.reload()
+            readiness.warmed_up = True
+            await readiness.check()
+            return
+        except Exception as e:
+            print(f"[STARTUP] Lỗi khởi tạo MongoDB: {e}, thử lại sau {STARTUP_RETRY_DELAY}s")
+            await asyncio.sleep(STARTUP_RETRY_DELAY)
+
 # Quản lý vòng đời app
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Khi server khởi động
-    await mqtt.mqtt_startup()
+    configure_logging()
+    settings = get_settings()
+    # Theo dõi thời gian từng lệnh MongoDB (phải đăng ký trước khi các task nền tạo client)
+    register_listener(get_tracer())
+    if settings.mqtt_capture_path:
+        capture.start(settings.mqtt_capture_path)
+    startup_tasks = [asyncio.create_task(start_mqtt()), asyncio.create_task(prepare_db())]
+    rule_engine.start_scheduler()
+    climate_aggregator.start()
+    readiness.start(settings.ready_interval)
     yield  # Server bắt đầu chạy
     
     # Khi server tắt
-    await mqtt.mqtt_shutdown()
+    for task in startup_tasks:
+        task.cancel()
+    await readiness.stop()
+    await rule_engine.stop_scheduler()
+    await climate_aggregator.stop()
+    await wait_pending_writes()
+    if mqtt_client.is_connected():
+        await get_mqtt().mqtt_shutdown()
+    close_client()
+    capture.stop()
     print("Server đang tắt...")
 
 app = FastAPI(lifespan=lifespan)
@@ -32,7 +88,17 @@ app.add_middleware(
 )
 # ============================================================
 
-mqtt.init_app(app)
+# Gắn mã tương quan cho mỗi request để trace lệnh MongoDB
+@app.middleware("http")
+async def correlation_middleware(request: Request, call_next):
+    request_id = request.headers.get("x-request-id") or new_request_id()
+    token = correlation_id.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        correlation_id.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
 
 # Root endpoint
 @app.get("/")
@@ -44,12 +110,15 @@ async def root():
         "endpoints": {
             "rooms": "/rooms",
             "devices": "/devices",
+            "rules": "/rules",
+            "analytics": "/analytics",
             "health": "/health",
+            "ready": "/ready",
             "mqtt-status": "/mqtt-status"
         }
     }
 
-# Health check endpoint
+# Health check endpoint (liveness: tiến trình còn chạy)
 @app.get("/health")
 async def health_check():
     return {
@@ -57,14 +126,23 @@ async def health_check():
         "timestamp": datetime.now().isoformat()
     }
 
+# Readiness endpoint: trả về kết quả kiểm tra Mongo/MQTT đã cache ở nền
+@app.get("/ready")
+async def ready_check():
+    return JSONResponse(
+        status_code=200 if readiness.ready else 503,
+        content=readiness.snapshot()
+    )
+
 # MQTT status endpoint
 @app.get("/mqtt-status")
 async def mqtt_status():
-    is_connected = mqtt.client is not None and mqtt.client.is_connected()
+    settings = get_settings()
+    is_connected = mqtt_client.is_connected()
     return {
         "mqtt_connected": is_connected,
-        "broker_host": "5b495904868d4c9e9e07c33dde4f6274.s1.eu.hivemq.cloud",
-        "broker_port": 8883,
+        "broker_host": settings.mqtt_host,
+        "broker_port": settings.mqtt_port,
         "status": "Connected ✅" if is_connected else "Disconnected ❌"
     }
 
@@ -72,16 +150,29 @@ async def mqtt_status():
 app.include_router(rooms.router, prefix="/rooms", tags=["Rooms"])
 app.include_router(devices.router, prefix="/devices", tags=["Devices"])
 app.include_router(commands.router, prefix="/commands", tags=["Commands"])
+app.include_router(rules.router, prefix="/rules", tags=["Rules"])
+app.include_router(analytics.router, prefix="/analytics", tags=["Analytics"])
+app.include_router(admin.router, prefix="/admin", tags=["Admin"])
 
-# MQTT Event Handlers
-@mqtt.on_connect()
+# MQTT Event Handlers (được đăng ký trong start_mqtt)
 def connect(client, flags, rc, properties):
     print(f"[MQTT] Connected to broker! rc={rc}, flags={flags}")
-    mqtt.client.subscribe("+/+")
+    client.subscribe("+/+")
     print("[MQTT] Subscribed to +/+ (all topics)")
 
-@mqtt.on_message()
+# Số message MQTT xử lý lỗi (handler nuốt exception nên cần đếm riêng, replay.py đọc giá trị này)
+message_errors = 0
+
 async def message(client, topic, payload, qos, properties):
+    global message_errors
+    # Capture chỉ để chẩn đoán: lỗi ghi file (đầy đĩa...) thì tắt capture, không làm hỏng ingest
+    if capture.enabled:
+        try:
+            capture.record(topic, payload)
+        except Exception as e:
+            print(f"[CAPTURE] Lỗi ghi file capture, dừng ghi: {e}")
+            capture.stop()
+    correlation_id.set(new_message_id())
     try:
         payload_str = payload.decode()
         print(f"[MQTT IN] Received: {topic} -> {payload_str} (qos={qos})")
@@ -100,76 +191,50 @@ async def message(client, topic, payload, qos, properties):
             if type_msg == "device":
                 print(f"[MQTT IN] Processing device update for room {room_id}: {data}")
                 if isinstance(data, dict):
-                    # Cập nhật currentLampStates trước
-                    update_lamp_states = {}
-                    for key, val in data.items():
-                        if key.startswith("device") and key in ["device1", "device2", "device3"]:
-                            update_lamp_states[f"currentLampStates.{key}"] = val
-
-                    if update_lamp_states:
-                        await db.devices.update_one(
+                    now = datetime.now()
+                    # Cập nhật trạng thái đèn trong state document (một lệnh ghi)
+                    changes = {key: val for key, val in data.items() if key in ["device1", "device2", "device3"]}
+
+                    if changes:
+                        before = await update_lamps(
                             {"roomId": room_id},
-                            {
-                                "$set": {
-                                    **update_lamp_states,
-                                    "isOnline": True,
-                                    "lastSeenAt": datetime.now()
-                                }
-                            }
+                            changes,
+                            now,
+                            extra={"isOnline": True, "lastSeenAt": now}
                         )
-
-                    # Cập nhật từng endpoint
-                    for key, val in data.items():
-                        try:
-                            if key.startswith("device"):
-                                endpoint_id = int(key.replace("device", ""))
-
-                                result = await db.devices.update_one(
-                                    {"roomId": room_id, "endpoints.id": endpoint_id},
-                                    {
-                                        "$set": {
-                                            "endpoints.$.value": val,
-                                            "endpoints.$.lastUpdated": datetime.now(),
-                                        }
-                                    }
-                                )
-                                if result.matched_count > 0:
-                                    print(f"-> Update: Phòng {room_id} - Ep {endpoint_id} = {val}")
-                        except ValueError:
-                            continue
+                        if before is not None:
+                            print(f"-> Update: Phòng {room_id} = {changes}")
                 else:
                     print("Lỗi: Payload device phải là JSON Object")
 
             elif type_msg == "status":
-                SENSOR_ENDPOINT_ID = 4
-
-                # Cập nhật currentSensorData
+                # Cập nhật dữ liệu cảm biến trong state document
                 if isinstance(data, dict):
-                    await db.devices.update_one(
+                    now = datetime.now()
+                    result = await db.device_states.update_one(
                         {"roomId": room_id},
                         {
                             "$set": {
-                                "currentSensorData.temperature": data.get("temperature", 0.0),
-                                "currentSensorData.humidity": data.get("humidity", 0.0),
-                                "isOnline": True
+                                "sensor.temperature": data.get("temperature", 0.0),
+                                "sensor.humidity": data.get("humidity", 0.0),
+                                f"updatedAt.{SENSOR_ENDPOINT_ID}": now,
+                                "isOnline": True,
+                                "lastSeenAt": now
                             }
                         }
                     )
 
-                result = await db.devices.update_one(
-                    {"roomId": room_id, "endpoints.id": SENSOR_ENDPOINT_ID},
-                    {
-                        "$set": {
-                            "endpoints.$.value": data,
-                            "endpoints.$.lastUpdated": datetime.now(),
-                        }
-                    }
-                )
-
-                if result.matched_count > 0:
-                    print(f"-> Update Sensor phòng {room_id}: {data}")
+                    if result.matched_count > 0:
+                        climate_aggregator.add(room_id, data, now)
+                        print(f"-> Update Sensor phòng {room_id}: {data}")
+                    else:
+                        print(f"Cảnh báo: Không tìm thấy thiết bị ở phòng {room_id}")
                 else:
-                    print(f"Cảnh báo: Không tìm thấy Sensor (id=4) ở phòng {room_id}")
+                    print("Lỗi: Payload status phải là JSON Object")
+
+            # Kiểm tra rule tự động hóa (chỉ các rule của phòng + loại topic này)
+            rule_engine.on_message(room_id, type_msg, data)
 
     except Exception as e:
+        message_errors += 1
         print(f"Lỗi xử lý MQTT: {e}")
@@ -0,0 +1,86 @@
+# Migration: tách trạng thái thiết bị sang collection device_states
+#
+# - Tạo state document cho mọi device chưa có (lấy giá trị từ currentLampStates,
+#   currentSensorData và endpoints[].value cũ)
+# - Xóa các field trùng lặp khỏi document Device
+#
+# Chạy lại nhiều lần vẫn an toàn: state đã tồn tại không bị ghi đè.
+#
+#   python migrate_device_state.py
+import asyncio
+from datetime import datetime
+from pymongo import UpdateOne
+from database import db
+from device_state import new_state, ensure_indexes, SENSOR_ENDPOINT_ID
+
+BATCH_SIZE = 500
+
+def build_state(device: dict) -> dict:
+    lamps = dict(device.get("currentLampStates") or {})
+    sensor = dict(device.get("currentSensorData") or {})
+    updated_at = {}
+
+    for ep in device.get("endpoints", []):
+        ep_id = ep.get("id")
+        if ep.get("lastUpdated") is not None:
+            updated_at[str(ep_id)] = ep["lastUpdated"]
+        if ep_id == SENSOR_ENDPOINT_ID:
+            if isinstance(ep.get("value"), dict) and not sensor:
+                sensor = {k: ep["value"].get(k, 0.0) for k in ("temperature", "humidity")}
+        elif f"device{ep_id}" not in lamps and isinstance(ep.get("value"), int):
+            lamps[f"device{ep_id}"] = ep["value"]
+
+    state = new_state(
+        device["_id"],
+        device.get("roomId"),
+        device.get("createdAt") or datetime.now(),
+        lamps={k: v for k, v in lamps.items() if k in ("device1", "device2", "device3")},
+        sensor=sensor,
+        is_online=device.get("isOnline", False),
+        last_seen_at=device.get("lastSeenAt")
+    )
+    state["updatedAt"].update(updated_at)
+    # Không biết đèn đã bật từ khi nào -> bắt đầu tính giờ bật từ lúc migrate
+    state["onSince"] = {key: datetime.now() if val else None for key, val in state["lamps"].items()}
+    return state
+
+async def flush(state_ops, device_ops):
+    if state_ops:
+        await db.device_states.bulk_write(state_ops, ordered=False)
+    if device_ops:
+        await db.devices.bulk_write(device_ops, ordered=False)
+
+async def migrate():
+    await ensure_indexes()
+
+    state_ops = []
+    device_ops = []
+    migrated = 0
+
+    async for device in db.devices.find({}):
+        state = build_state(device)
+        state_id = state.pop("_id")
+        state_ops.append(UpdateOne({"_id": state_id}, {"$setOnInsert": state}, upsert=True))
+        unset_fields = {
+            "currentLampStates": "",
+            "currentSensorData": "",
+            "isOnline": "",
+            "lastSeenAt": ""
+        }
+        # $[] chỉ dùng được khi endpoints là mảng
+        if isinstance(device.get("endpoints"), list):
+            unset_fields["endpoints.$[].value"] = ""
+            unset_fields["endpoints.$[].lastUpdated"] = ""
+        device_ops.append(UpdateOne({"_id": device["_id"]}, {"$unset": unset_fields}))
+        migrated += 1
+
+        if len(state_ops) >= BATCH_SIZE:
+            await flush(state_ops, device_ops)
+            state_ops, device_ops = [], []
+            print(f"[MIGRATE] Đã xử lý {migrated} thiết bị")
+
+    await flush(state_ops, device_ops)
+    print(f"[MIGRATE] Hoàn tất: {migrated} thiết bị")
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
@@ -55,6 +55,32 @@ class Command(MongoBaseModel):
     createdAt: datetime = Field(default_factory=datetime.now)
     ackedAt: Optional[datetime] = None
 
+# RuleTrigger - Điều kiện kích hoạt rule
+class RuleTrigger(BaseModel):
+    type: str # status, device (theo message MQTT) hoặc schedule (theo giờ)
+    field: Optional[str] = None # temperature, humidity, device1...
+    op: Optional[str] = None # >, >=, <, <=, ==, !=
+    value: Optional[float] = None
+    at: Optional[str] = None # "HH:MM" cho rule theo giờ
+    days: Optional[List[int]] = None # 0 = Thứ 2 ... 6 = Chủ nhật, None = mọi ngày
+
+# RuleAction - Hành động khi rule khớp
+class RuleAction(BaseModel):
+    command: str # TURN_ON, TURN_OFF
+    deviceId: Optional[str] = None
+    roomId: Optional[str] = None
+    floor: Optional[int] = None
+    endpointId: Optional[int] = None # None = tất cả đèn (1-3)
+
+# Rule - Luật tự động hóa
+class Rule(MongoBaseModel):
+    name: str
+    roomId: Optional[str] = None # Phòng theo dõi, None = mọi phòng
+    trigger: RuleTrigger
+    action: RuleAction
+    enabled: bool = True
+    createdAt: datetime = Field(default_factory=datetime.now)
+
 # ===== Request Models =====
 
 class RoomCreateRequest(BaseModel):
@@ -69,6 +95,13 @@ class DeviceCreateRequest(BaseModel):
     roomId: str
     name: str
 
+# Một dòng trong file provisioning (NDJSON/CSV)
+class DeviceProvisionRow(BaseModel):
+    roomId: str
+    name: str
+    serialNo: Optional[str] = None
+    bleMac: Optional[str] = None
+
 class DeviceUpdateRequest(BaseModel):
     name: Optional[str] = None
     roomId: Optional[str] = None
@@ -86,4 +119,14 @@ class CommandRequest(BaseModel):
     deviceId: Optional[str] = None
     endpointId: int
     command: str # TURN_ON, TURN_OFF
-    payload: Optional[str] = None
\ No newline at end of file
+    payload: Optional[str] = None
+
+class RuleCreateRequest(BaseModel):
+    name: str
+    roomId: Optional[str] = None
+    trigger: RuleTrigger
+    action: RuleAction
+    enabled: bool = True
+
+class RuleUpdateRequest(BaseModel):
+    enabled: Optional[bool] = None
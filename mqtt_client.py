@@ -1,35 +1,54 @@
 from fastapi_mqtt import FastMQTT, MQTTConfig
-import os
-from dotenv import load_dotenv
 import ssl
 import logging
+from config import get_settings
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)  # Đổi từ DEBUG sang INFO để giảm log spam
 logger = logging.getLogger(__name__)
 
-# Tắt log của MQTT library để không spam heartbeat
-logging.getLogger("gmqtt").setLevel(logging.WARNING)
-logging.getLogger("fastapi_mqtt").setLevel(logging.WARNING)
+_mqtt = None
 
-load_dotenv()
+# Setup logging (gọi trong lifespan, không chạy lúc import)
+def configure_logging():
+    logging.basicConfig(level=logging.INFO)  # Đổi từ DEBUG sang INFO để giảm log spam
 
-logger.info("=== MQTT Configuration ===")
-logger.info(f"MQTT_HOST: {os.getenv('MQTT_HOST')}")
-logger.info(f"MQTT_PORT: {os.getenv('MQTT_PORT')}")
-logger.info(f"MQTT_USER: {os.getenv('MQTT_USER')}")
+    # Tắt log của MQTT library để không spam heartbeat
+    logging.getLogger("gmqtt").setLevel(logging.WARNING)
+    logging.getLogger("fastapi_mqtt").setLevel(logging.WARNING)
 
 # Cấu hình MQTT
-mqtt_config = MQTTConfig(
-    host = os.getenv("MQTT_HOST"),
-    port = int(os.getenv("MQTT_PORT")),
-    username = os.getenv("MQTT_USER"),
-    password = os.getenv("MQTT_PASSWORD"),
-    keepalive = 60,
-    ssl = ssl.create_default_context()
-)
-
-logger.info("Creating MQTT client...")
-# Khởi tạo đối tượng MQTT
-mqtt = FastMQTT(config=mqtt_config)
-logger.info("MQTT client created successfully")
\ No newline at end of file
+def build_config() -> MQTTConfig:
+    settings = get_settings()
+
+    logger.info("=== MQTT Configuration ===")
+    logger.info(f"MQTT_HOST: {settings.mqtt_host}")
+    logger.info(f"MQTT_PORT: {settings.mqtt_port}")
+    logger.info(f"MQTT_USER: {settings.mqtt_user}")
+
+    return MQTTConfig(
+        host = settings.mqtt_host,
+        port = settings.mqtt_port,
+        username = settings.mqtt_user,
+        password = settings.mqtt_password,
+        keepalive = 60,
+        ssl = ssl.create_default_context() if settings.mqtt_tls else False
+    )
+
+# Khởi tạo đối tượng MQTT khi cần tới lần đầu
+def get_mqtt() -> FastMQTT:
+    global _mqtt
+    if _mqtt is None:
+        logger.info("Creating MQTT client...")
+        _mqtt = FastMQTT(config=build_config())
+        logger.info("MQTT client created successfully")
+    return _mqtt
+
+# Kiểm tra kết nối mà không tạo client
+def is_connected() -> bool:
+    return _mqtt is not None and _mqtt.client.is_connected
+
+# Cho phép các module dùng `mqtt.publish(...)` như cũ
+class _LazyMQTT:
+    def __getattr__(self, name):
+        return getattr(get_mqtt(), name)
+
+mqtt = _LazyMQTT()
@@ -0,0 +1,168 @@
+import itertools
+import math
+import time
+from fastapi import HTTPException
+from config import get_settings
+
+# Token bucket trong bộ nhớ: mỗi key là một list [tokens, lần cập nhật cuối]
+# Số bucket bị giới hạn cứng bởi max_keys: khi đầy sẽ bỏ bucket đã hồi đầy,
+# rồi bỏ bucket cũ nhất cho tới khi còn PRUNE_TARGET * max_keys.
+PRUNE_TARGET = 0.9
+
+class RateLimiter:
+    def __init__(self, rate: float, burst: float, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.rejected = 0
+        self._buckets = {}
+
+    # Số giây cần chờ để có 1 token (0 = được phép), không trừ token
+    def wait(self, key, now: float) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return 0.0
+        tokens = bucket[0] + (now - bucket[1]) * self.rate
+        if tokens >= 1:
+            return 0.0
+        return (1 - tokens) / self.rate
+
+    # Trừ 1 token (gọi sau khi wait() trả về 0)
+    def take(self, key, now: float):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._prune(now)
+            self._buckets[key] = [self.burst - 1, now]
+            return
+        tokens = bucket[0] + (now - bucket[1]) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        bucket[0] = tokens - 1
+        bucket[1] = now
+
+    # Trả về 0 nếu được phép (và trừ token), ngược lại số giây cần chờ
+    def acquire(self, key, now: float) -> float:
+        wait = self.wait(key, now)
+        if wait:
+            self.rejected += 1
+            return wait
+        self.take(key, now)
+        return 0.0
+
+    # Giảm số bucket xuống dưới ngưỡng một lần để chi phí O(n) được chia đều cho nhiều key mới
+    def _prune(self, now: float):
+        full_after = self.burst / self.rate
+        buckets = {
+            key: bucket for key, bucket in self._buckets.items()
+            if now - bucket[1] < full_after
+        }
+        target = int(self.max_keys * PRUNE_TARGET)
+        if len(buckets) > target:
+            # Dict giữ thứ tự chèn -> các key đầu là bucket cũ nhất
+            excess = len(buckets) - target
+            for key in list(itertools.islice(buckets, excess)):
+                del buckets[key]
+        self._buckets = buckets
+
+    def __len__(self):
+        return len(self._buckets)
+
+def too_many_requests(retry_after: float, detail: str):
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+REJECT_MESSAGES = {
+    "client": "Quá nhiều lệnh từ client này",
+    "device": "Quá nhiều lệnh cho thiết bị này",
+    "room": "Quá nhiều lệnh cho phòng này",
+}
+
+# Giới hạn lệnh điều khiển theo device, phòng, client + giới hạn số lệnh đang gửi
+class CommandLimiter:
+    def __init__(self):
+        settings = get_settings()
+        self.device = RateLimiter(settings.cmd_rate_device, settings.cmd_burst_device)
+        self.room = RateLimiter(settings.cmd_rate_room, settings.cmd_burst_room)
+        self.client = RateLimiter(settings.cmd_rate_client, settings.cmd_burst_client)
+        self.max_in_flight = settings.cmd_max_in_flight
+        self.in_flight = 0
+        self.rejected_in_flight = 0
+
+    # Trả về None nếu được phép, ngược lại (loại giới hạn, số giây cần chờ).
+    # Kiểm tra mọi bucket trước, chỉ trừ token khi tất cả đều cho phép
+    # (request bị chặn không làm tốn quota của các bucket khác).
+    # consume=False: chỉ kiểm tra, dùng để chặn sớm trước khi chạm tới DB
+    def try_acquire(self, device_id: str = None, room_id: str = None, client: str = None, consume: bool = True):
+        now = time.monotonic()
+        checks = [
+            (kind, limiter, key)
+            for kind, limiter, key in (
+                ("client", self.client, client),
+                ("device", self.device, device_id),
+                ("room", self.room, room_id),
+            )
+            if key is not None
+        ]
+        for kind, limiter, key in checks:
+            wait = limiter.wait(key, now)
+            if wait:
+                limiter.rejected += 1
+                return kind, wait
+        if consume:
+            for _, limiter, key in checks:
+                limiter.take(key, now)
+        return None
+
+    # Dùng cho API: ném 429 kèm Retry-After
+    def check(self, device_id: str = None, room_id: str = None, client: str = None, consume: bool = True):
+        rejected = self.try_acquire(device_id, room_id, client, consume)
+        if rejected:
+            kind, wait = rejected
+            raise too_many_requests(wait, REJECT_MESSAGES[kind])
+
+    # Giới hạn tổng số lệnh đang xử lý / publish cùng lúc
+    def acquire_in_flight(self):
+        if self.in_flight >= self.max_in_flight:
+            self.rejected_in_flight += 1
+            raise too_many_requests(1, "Hệ thống đang bận, thử lại sau")
+        self.in_flight += 1
+
+    def release_in_flight(self):
+        self.in_flight -= 1
+
+    def metrics(self):
+        return {
+            "rejected": {
+                "client": self.client.rejected,
+                "device": self.device.rejected,
+                "room": self.room.rejected,
+                "in_flight": self.rejected_in_flight
+            },
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "tracked_keys": {
+                "client": len(self.client),
+                "device": len(self.device),
+                "room": len(self.room)
+            }
+        }
+
+_command_limiter = None
+
+def get_command_limiter() -> CommandLimiter:
+    global _command_limiter
+    if _command_limiter is None:
+        _command_limiter = CommandLimiter()
+    return _command_limiter
+
+# Key của client: API key nếu nằm trong danh sách API_KEYS, không thì địa chỉ IP
+# (header không được xác thực không thể dùng làm key, client sẽ đổi key để né giới hạn)
+def client_key(request) -> str:
+    api_key = request.headers.get("x-api-key")
+    if api_key and api_key in get_settings().api_keys:
+        return f"key:{api_key}"
+    return request.client.host if request.client else "unknown"
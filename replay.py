@@ -0,0 +1,204 @@
+# Phát lại file capture MQTT để kiểm tra tải (capacity planning)
+#
+#   python replay.py capture.bin                      # 1x, gọi thẳng main.message
+#   python replay.py capture.bin --speed 10           # nhanh gấp 10 lần
+#   python replay.py capture.bin --speed max --quiet  # nhanh nhất có thể
+#   python replay.py capture.bin --db smart_home_replay  # ghi vào DB riêng
+#   python replay.py capture.bin --mode broker --host localhost --port 1883
+#
+# Chế độ direct gọi thẳng handler và đếm số lệnh MongoDB do handler sinh ra.
+# Chế độ này GHI vào DB_NAME trong .env (device_states, commands, thống kê...),
+# nên dùng --db để trỏ sang một DB thử nghiệm. Không có MQTT client: lệnh do
+# rule sinh ra không được publish mà chỉ được đếm.
+# Chế độ broker publish lên broker (server đang chạy sẽ xử lý), chỉ báo cáo
+# throughput phía publish.
+import argparse
+import asyncio
+import contextlib
+import os
+import time
+from collections import Counter
+from pymongo import monitoring
+from capture import read_capture
+
+# Đếm lệnh MongoDB theo tên (find, update, insert...)
+# Thay cho MQTT client trong chế độ direct: đếm các lệnh lẽ ra được publish
+class PublishCounter:
+    def __init__(self):
+        self.count = 0
+
+    def publish(self, topic, payload, qos=0):
+        self.count += 1
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.counts = Counter()
+        self.failed = 0
+
+    def started(self, event):
+        self.counts[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        self.failed += 1
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+# Ngủ tới thời điểm message cần được phát (theo tỉ lệ thời gian)
+async def wait_until(first_ts, ts, start, speed):
+    if speed is None:
+        return
+    delay = (ts - first_ts) / speed - (time.perf_counter() - start)
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+async def replay_direct(path, speed):
+    import database
+    counter = CommandCounter()
+    database.register_listener(counter)
+
+    import main
+    import command_service
+    publisher = PublishCounter()
+    command_service.mqtt = publisher
+    command_service.is_connected = lambda: True
+    from automation import rule_engine
+    from analytics import climate_aggregator, wait_pending_writes
+    # Không chạy lifespan -> tự nạp rule để đo cả chi phí so khớp + hành động
+    await rule_engine.reload()
+    errors_before = main.message_errors
+    actions_failed_before = rule_engine.actions_failed
+
+    latencies = []
+    errors = 0
+    tasks = set()
+
+    async def handle(topic, payload):
+        nonlocal errors
+        t = time.perf_counter()
+        try:
+            await main.message(None, topic, payload, 0, None)
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - t)
+
+    first_ts = None
+    start = time.perf_counter()
+    for ts, topic, payload in read_capture(path):
+        if first_ts is None:
+            first_ts = ts
+        await wait_until(first_ts, ts, start, speed)
+        task = asyncio.create_task(handle(topic, payload))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    # Đợi các hành động rule chạy nền (nếu có) để đếm đủ lệnh DB
+    if rule_engine._tasks:
+        await asyncio.gather(*rule_engine._tasks, return_exceptions=True)
+    await climate_aggregator.flush()
+    await wait_pending_writes()
+
+    database.close_client()
+    return {
+        "messages": len(latencies),
+        "elapsed": elapsed,
+        # Handler tự bắt exception -> lấy số lỗi từ bộ đếm của main
+        "errors": errors + main.message_errors - errors_before,
+        "rule_failed": rule_engine.actions_failed - actions_failed_before,
+        "latencies": latencies,
+        "publishes": publisher.count,
+        "db_ops": counter.counts,
+        "db_failed": counter.failed,
+    }
+
+async def replay_broker(path, speed, host, port, tls, username, password):
+    from gmqtt import Client
+    client = Client(f"replay-{os.getpid()}")
+    if username:
+        client.set_auth_credentials(username, password)
+    await client.connect(host, port, ssl=tls)
+
+    count = 0
+    first_ts = None
+    start = time.perf_counter()
+    for ts, topic, payload in read_capture(path):
+        if first_ts is None:
+            first_ts = ts
+        await wait_until(first_ts, ts, start, speed)
+        client.publish(topic, payload, qos=0)
+        count += 1
+        # Nhường event loop để gmqtt gửi dữ liệu đi
+        if count % 100 == 0:
+            await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+    await client.disconnect()
+    return {"messages": count, "elapsed": elapsed}
+
+def print_report(result):
+    messages = result["messages"]
+    elapsed = result["elapsed"] or 1e-9
+    print("=== Replay report ===")
+    print(f"Messages:    {messages}")
+    print(f"Elapsed:     {elapsed:.3f}s")
+    print(f"Throughput:  {messages / elapsed:.1f} msg/s")
+
+    if "latencies" in result:
+        latencies = result["latencies"]
+        print(f"Errors:      {result['errors']}")
+        print(f"Rule fails:  {result['rule_failed']}")
+        print(f"Publishes:   {result['publishes']} (không gửi thật)")
+        print(
+            "Handler ms:  "
+            f"p50={percentile(latencies, 50) * 1000:.2f} "
+            f"p99={percentile(latencies, 99) * 1000:.2f} "
+            f"max={max(latencies, default=0) * 1000:.2f}"
+        )
+        total_ops = sum(result["db_ops"].values())
+        print(f"DB ops:      {total_ops} ({total_ops / messages if messages else 0:.2f}/msg, failed={result['db_failed']})")
+        for name, n in result["db_ops"].most_common():
+            print(f"  {name:<12} {n}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Phát lại file capture MQTT")
+    parser.add_argument("path")
+    parser.add_argument("--speed", default="1", help="Hệ số tốc độ (1, 10, ...) hoặc 'max'")
+    parser.add_argument("--mode", choices=["direct", "broker"], default="direct")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--tls", action="store_true")
+    parser.add_argument("--username")
+    parser.add_argument("--password")
+    parser.add_argument("--db", help="Tên DB dùng cho chế độ direct (mặc định DB_NAME)")
+    parser.add_argument("--quiet", action="store_true", help="Ẩn log print của handler")
+    args = parser.parse_args()
+
+    # Đặt trước khi Settings được đọc lần đầu (load_dotenv không ghi đè biến đã có)
+    if args.db:
+        os.environ["DB_NAME"] = args.db
+
+    speed = None if args.speed == "max" else float(args.speed)
+
+    if args.mode == "direct":
+        run = replay_direct(args.path, speed)
+    else:
+        run = replay_broker(args.path, speed, args.host, args.port, args.tls, args.username, args.password)
+
+    if args.quiet:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result = asyncio.run(run)
+    else:
+        result = asyncio.run(run)
+
+    print_report(result)
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,6 @@
 from . import rooms
 from . import devices
 from . import commands
+from . import rules
+from . import admin
+from . import analytics
@@ -0,0 +1,20 @@
+from fastapi import APIRouter
+from tracing import get_tracer
+from singleflight import get_read_coalescer
+
+router = APIRouter()
+
+# API xem các lệnh MongoDB chậm nhất gần đây
+@router.get("/slow-queries")
+async def get_slow_queries(limit: int = 20, window: int = 600):
+    return get_tracer().top(limit=limit, window_s=window)
+
+# API xem thống kê thời gian theo collection + lệnh
+@router.get("/db-stats")
+async def get_db_stats():
+    return get_tracer().summary()
+
+# API xem số liệu gộp request đọc (single-flight)
+@router.get("/read-coalescing")
+async def get_read_coalescing():
+    return get_read_coalescer().metrics()
@@ -0,0 +1,157 @@
+from fastapi import APIRouter, HTTPException
+from typing import Optional
+from database import db
+from datetime import datetime, timedelta
+from analytics import day_key, split_by_day
+from device_state import LAMP_KEYS
+
+router = APIRouter()
+
+# Khoảng ngày [start, end] dạng YYYY-MM-DD, mặc định 30 ngày gần nhất
+def date_range(start: Optional[str], end: Optional[str]):
+    try:
+        end_dt = datetime.strptime(end, "%Y-%m-%d") if end else datetime.now()
+        start_dt = datetime.strptime(start, "%Y-%m-%d") if start else end_dt - timedelta(days=29)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start/end phải có dạng YYYY-MM-DD")
+    if start_dt > end_dt:
+        raise HTTPException(status_code=400, detail="start phải trước end")
+    return day_key(start_dt), day_key(end_dt)
+
+def to_hours(seconds) -> float:
+    return round((seconds or 0) / 3600, 3)
+
+def average(total, count):
+    return round(total / count, 2) if count else None
+
+# Khoảng bật chưa kết thúc (đèn đang bật) chưa được cộng vào lamp_usage_daily -> tính thêm lúc truy vấn.
+# Trả về {(roomId, ngày): {device1: s, ...}} trong khoảng ngày [start_key, end_key]
+async def open_intervals(start_key: str, end_key: str, room_id: Optional[str], now: datetime):
+    query = {"$or": [{f"onSince.{key}": {"$type": "date"}} for key in LAMP_KEYS]}
+    if room_id:
+        query["roomId"] = room_id
+    states = await db.device_states.find(query, {"roomId": 1, "onSince": 1}).to_list(length=None)
+
+    seconds_by_day = {}
+    for state in states:
+        if not state.get("roomId"):
+            continue
+        on_since = state.get("onSince") or {}
+        for key in LAMP_KEYS:
+            started = on_since.get(key)
+            if not isinstance(started, datetime):
+                continue
+            for date, seconds in split_by_day(started, now):
+                if start_key <= date <= end_key:
+                    acc = seconds_by_day.setdefault((state.get("roomId"), date), {})
+                    acc[key] = acc.get(key, 0) + seconds
+    return seconds_by_day
+
+# API số giờ bật đèn theo phòng (theo ngày hoặc tổng theo phòng)
+@router.get("/lamp-usage")
+async def get_lamp_usage(
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    roomId: Optional[str] = None,
+    groupBy: str = "day"
+):
+    start_key, end_key = date_range(start, end)
+    match = {"date": {"$gte": start_key, "$lte": end_key}}
+    if roomId:
+        match["roomId"] = roomId
+
+    if groupBy not in ("day", "room"):
+        raise HTTPException(status_code=400, detail="groupBy phải là day hoặc room")
+
+    open_seconds = await open_intervals(start_key, end_key, roomId, datetime.now())
+
+    if groupBy == "day":
+        docs = await db.lamp_usage_daily.find(match).to_list(length=None)
+        usage = {
+            (doc["roomId"], doc["date"]): {key: doc.get("onSeconds", {}).get(key) or 0 for key in LAMP_KEYS}
+            for doc in docs
+        }
+        for day, seconds in open_seconds.items():
+            acc = usage.setdefault(day, {key: 0 for key in LAMP_KEYS})
+            for key, val in seconds.items():
+                acc[key] += val
+        return [
+            {
+                "roomId": room_id,
+                "date": date,
+                "onHours": {key: to_hours(seconds[key]) for key in LAMP_KEYS},
+                "totalOnHours": to_hours(sum(seconds.values()))
+            }
+            for (room_id, date), seconds in sorted(usage.items())
+        ]
+
+    group = {"_id": "$roomId"}
+    for key in LAMP_KEYS:
+        group[key] = {"$sum": f"$onSeconds.{key}"}
+    docs = await db.lamp_usage_daily.aggregate([
+        {"$match": match},
+        {"$group": group}
+    ]).to_list(length=None)
+    usage = {doc["_id"]: {key: doc.get(key) or 0 for key in LAMP_KEYS} for doc in docs}
+    for (room_id, _), seconds in open_seconds.items():
+        acc = usage.setdefault(room_id, {key: 0 for key in LAMP_KEYS})
+        for key, val in seconds.items():
+            acc[key] += val
+    return [
+        {
+            "roomId": room_id,
+            "start": start_key,
+            "end": end_key,
+            "onHours": {key: to_hours(seconds[key]) for key in LAMP_KEYS},
+            "totalOnHours": to_hours(sum(seconds.values()))
+        }
+        for room_id, seconds in sorted(usage.items())
+    ]
+
+# API nhiệt độ / độ ẩm trung bình theo tầng, phòng hoặc ngày
+@router.get("/climate")
+async def get_climate(
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    floor: Optional[int] = None,
+    roomId: Optional[str] = None,
+    groupBy: str = "floor"
+):
+    group_keys = {"floor": "$floor", "room": "$roomId", "day": "$date"}
+    if groupBy not in group_keys:
+        raise HTTPException(status_code=400, detail="groupBy phải là floor, room hoặc day")
+
+    start_key, end_key = date_range(start, end)
+    match = {"date": {"$gte": start_key, "$lte": end_key}}
+    if floor is not None:
+        match["floor"] = floor
+    if roomId:
+        match["roomId"] = roomId
+
+    docs = await db.climate_daily.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": group_keys[groupBy],
+            "tempSum": {"$sum": "$tempSum"},
+            "tempCount": {"$sum": "$tempCount"},
+            "tempMin": {"$min": "$tempMin"},
+            "tempMax": {"$max": "$tempMax"},
+            "humSum": {"$sum": "$humSum"},
+            "humCount": {"$sum": "$humCount"}
+        }},
+        {"$sort": {"_id": 1}}
+    ]).to_list(length=None)
+
+    return [
+        {
+            groupBy: doc["_id"],
+            "start": start_key,
+            "end": end_key,
+            "avgTemperature": average(doc["tempSum"], doc["tempCount"]),
+            "minTemperature": doc.get("tempMin"),
+            "maxTemperature": doc.get("tempMax"),
+            "avgHumidity": average(doc["humSum"], doc["humCount"]),
+            "samples": doc["tempCount"]
+        }
+        for doc in docs
+    ]
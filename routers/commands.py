@@ -1,16 +1,15 @@
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, Request, status
 from database import db
-from models import CommandRequest, Command
-from datetime import datetime
+from models import CommandRequest
 from bson import ObjectId
-from mqtt_client import mqtt
-import json
+from command_service import send_lamp_command
+from ratelimit import get_command_limiter, client_key
 
 router = APIRouter()
 
 # API gửi lệnh điều khiển endpoint qua MQTT
 @router.post("/", status_code=status.HTTP_201_CREATED)
-async def send_command(cmd_req: CommandRequest):
+async def send_command(cmd_req: CommandRequest, request: Request):
     if not cmd_req.deviceId:
         raise HTTPException(status_code=400, detail="Thiếu deviceId")
     
@@ -26,87 +25,32 @@ async def send_command(cmd_req: CommandRequest):
     except Exception:
         raise HTTPException(status_code=400, detail=f"deviceId không hợp lệ: '{device_id}' (phải là 24 ký tự hex)")
 
-    device = await db.devices.find_one({"_id": device_obj_id})
+    # Chặn sớm client đã hết quota trước khi chạm tới DB (chưa trừ token)
+    limiter = get_command_limiter()
+    client = client_key(request)
+    limiter.check(client=client, consume=False)
+
+    device = await db.devices.find_one({"_id": device_obj_id}, {"roomId": 1})
     if not device:
         raise HTTPException(status_code=404, detail="Thiết bị không tồn tại")
 
-    new_command = Command(
-        commandId=str(ObjectId()),
-        deviceId=device_id,
-        endpointId=cmd_req.endpointId,
-        command=cmd_req.command,
-        payload=cmd_req.payload,
-        status="PENDING",
-        createdAt=datetime.now()
-    )
-
-    await db.commands.insert_one(new_command.model_dump(by_alias=True, exclude=["id"]))
-
-    room_id = device.get("roomId")
-    if not room_id:
-        raise HTTPException(status_code=400, detail="Thiết bị chưa được gán vào phòng")
-
-    target_val = 1 if cmd_req.command == "TURN_ON" else 0
-
-    # === ĐẢM BẢO DEVICE CÓ currentLampStates (khởi tạo nếu chưa có) ===
-    if "currentLampStates" not in device or device.get("currentLampStates") is None:
-        await db.devices.update_one(
-            {"_id": device_obj_id},
-            {"$set": {"currentLampStates": {"device1": 0, "device2": 0, "device3": 0}}}
-        )
-
-    # === CẬP NHẬT DATABASE: currentLampStates + endpoints ===
-    update_data = {
-        f"currentLampStates.device{cmd_req.endpointId}": target_val
-    }
-    
-    # 1) Cập nhật currentLampStates luôn
-    await db.devices.update_one(
-        {"_id": device_obj_id},
-        {"$set": update_data}
-    )
-    
-    # 2) Cũng cập nhật endpoint nếu tồn tại
-    result = await db.devices.update_one(
-        {"_id": device_obj_id, "endpoints.id": cmd_req.endpointId},
-        {"$set": {
-            "endpoints.$.value": target_val,
-            "endpoints.$.lastUpdated": datetime.now()
-        }}
-    )
-    
-    if result.matched_count == 0:
-        print(f"[WARN] Endpoint {cmd_req.endpointId} không tìm thấy trong array endpoints")
-    
-    # === LẤY TRẠNG THÁI MỚI TỪ currentLampStates (ƯU TIÊN) ===
-    updated_device = await db.devices.find_one({"_id": device_obj_id})
-    lamp_states = updated_device.get("currentLampStates", {})
-
-    payload = {
-        "device1": lamp_states.get("device1", 0),
-        "device2": lamp_states.get("device2", 0),
-        "device3": lamp_states.get("device3", 0),
-    }
+    # Trừ token client + thiết bị + phòng cùng lúc, chỉ khi thiết bị có thật và không bucket nào chặn
+    limiter.check(device_id=device_id, room_id=device.get("roomId"), client=client)
 
-    topic = f"{room_id}/device"
-    payload_json = json.dumps(payload)
-    
-    # Kiểm tra MQTT connection
-    if not mqtt.client or not mqtt.client.is_connected:
-        print("[ERROR] MQTT client not connected!")
-        raise HTTPException(status_code=503, detail="MQTT broker không kết nối")
-    
-    # Publish với QoS=1 để đảm bảo ESP nhận được
-    mqtt.publish(topic, payload_json, qos=1)
-    print(f"[COMMAND] Published to {topic}: {payload_json}")
+    result = await send_lamp_command(device, [cmd_req.endpointId], cmd_req.command, cmd_req.payload, source="COMMAND")
 
     return {
         "message": "Đã gửi lệnh xuống thiết bị",
-        "commandId": new_command.commandId,
-        "mqtt_topic": topic,
-        "payload": payload
+        "commandId": result["commandIds"][0],
+        "mqtt_topic": result["mqtt_topic"],
+        "payload": result["payload"]
     }
 
+# API xem số liệu giới hạn tần suất lệnh
+@router.get("/rate-limit")
+async def get_rate_limit_metrics():
+    return get_command_limiter().metrics()
+
 # API lấy lịch sử lệnh
 @router.get("/history/{device_id}")
 async def get_command_history(
@@ -1,14 +1,36 @@
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, Request, status
 from typing import List
 from database import db
-from models import CommandRequest, Device, DeviceCreateRequest, DeviceUpdateRequest, Command, EndpointCreateRequest, EndpointUpdateRequest, DeviceEndpoint
+from models import CommandRequest, Device, DeviceCreateRequest, DeviceProvisionRow, DeviceUpdateRequest, EndpointCreateRequest, EndpointUpdateRequest, DeviceEndpoint
 from datetime import datetime
-from bson import ObjectId
-from mqtt_client import mqtt
+import csv
 import json
+from bson import ObjectId
+from pydantic import TypeAdapter, ValidationError
+from pymongo.errors import BulkWriteError
+from command_service import send_lamp_command
+from ratelimit import get_command_limiter, client_key
+from singleflight import get_read_coalescer, json_response
+from device_state import new_state, attach_state, attach_states
 
 router = APIRouter()
 
+DEVICE_LIST = TypeAdapter(List[Device])
+
+# 4 endpoints mặc định: 3 SWITCH (id 1-3) + 1 SENSOR (id 4)
+# Chỉ lưu metadata, giá trị hiện tại nằm ở device_states
+DEFAULT_ENDPOINTS = [
+    {"id": 1, "name": "Đèn 1", "type": "SWITCH"},
+    {"id": 2, "name": "Đèn 2", "type": "SWITCH"},
+    {"id": 3, "name": "Đèn 3", "type": "SWITCH"},
+    {"id": 4, "name": "Cảm biến môi trường", "type": "SENSOR"},
+]
+
+DEVICE_STATE_FIELDS = ["id", "endpoints", "currentLampStates", "currentSensorData", "isOnline", "lastSeenAt"]
+
+BULK_BATCH_SIZE = 500
+CSV_COLUMNS = ["roomId", "name", "serialNo", "bleMac"]
+
 # API tạo thiết bị (ESP) mới cho phòng
 @router.post("/", status_code=status.HTTP_201_CREATED)
 async def create_device(device_req: DeviceCreateRequest):
@@ -17,30 +39,189 @@ async def create_device(device_req: DeviceCreateRequest):
     if not room:
         raise HTTPException(status_code=404, detail="Phòng không tồn tại")
 
-    # Tạo 4 endpoints mặc định: 3 SWITCH (id 1-3) + 1 SENSOR (id 4)
-    default_endpoints = [
-        DeviceEndpoint(id=1, name="Đèn 1", type="SWITCH", value=0, lastUpdated=datetime.now()).model_dump(),
-        DeviceEndpoint(id=2, name="Đèn 2", type="SWITCH", value=0, lastUpdated=datetime.now()).model_dump(),
-        DeviceEndpoint(id=3, name="Đèn 3", type="SWITCH", value=0, lastUpdated=datetime.now()).model_dump(),
-        DeviceEndpoint(id=4, name="Cảm biến môi trường", type="SENSOR", value={"temperature": 0.0, "humidity": 0.0}, lastUpdated=datetime.now()).model_dump(),
-    ]
-
+    now = datetime.now()
     new_device = Device(
         roomId=device_req.roomId,
         name=device_req.name,
-        endpoints=default_endpoints,
-        currentLampStates={"device1": 0, "device2": 0, "device3": 0},
-        currentSensorData={"temperature": 0.0, "humidity": 0.0},
-        createdAt=datetime.now()
+        createdAt=now
     )
+    device_doc = new_device.model_dump(by_alias=True, exclude=DEVICE_STATE_FIELDS)
+    device_doc["endpoints"] = [dict(ep) for ep in DEFAULT_ENDPOINTS]
 
-    result = await db.devices.insert_one(new_device.model_dump(by_alias=True, exclude=["id"]))
+    result = await db.devices.insert_one(device_doc)
+    await db.device_states.insert_one(new_state(result.inserted_id, device_req.roomId, now))
+    get_read_coalescer().invalidate()
 
     return {
         "message": "Tạo thiết bị thành công",
         "deviceId": str(result.inserted_id)
     }
 
+# Đọc body theo từng dòng khi dữ liệu đang được gửi lên.
+# Dòng không phải UTF-8 được trả về dưới dạng ValueError để báo lỗi riêng dòng đó
+def decode_line(line: bytes, first: bool):
+    try:
+        return line.decode("utf-8-sig" if first else "utf-8").rstrip("\r")
+    except UnicodeDecodeError as e:
+        return ValueError(f"Dòng không phải UTF-8: {e}")
+
+async def iter_lines(request: Request):
+    buffer = b""
+    first = True
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield decode_line(line, first)
+            first = False
+    if buffer:
+        yield decode_line(buffer, first)
+
+# Ghép các dòng thành bản ghi CSV: trường trong ngoặc kép có thể chứa xuống dòng
+# (dấu " bên trong trường được nhân đôi nên tổng số dấu " lẻ nghĩa là trường chưa đóng)
+async def iter_csv_records(request: Request):
+    record = None
+    quotes = 0
+    async for line in iter_lines(request):
+        if isinstance(line, Exception):
+            # Dòng lỗi nằm giữa bản ghi nhiều dòng -> bỏ cả bản ghi, báo một lỗi
+            yield line
+            record = None
+            quotes = 0
+            continue
+        record = line if record is None else f"{record}\n{line}"
+        quotes += line.count('"')
+        if quotes % 2 == 0:
+            yield record
+            record = None
+            quotes = 0
+    if record is not None:
+        yield record
+
+# Chuyển body NDJSON/CSV thành các dòng (số dòng, dict)
+async def iter_rows(request: Request):
+    is_csv = "csv" in request.headers.get("content-type", "")
+    columns = None
+    row_no = 0
+
+    async for line in (iter_csv_records(request) if is_csv else iter_lines(request)):
+        if isinstance(line, Exception):
+            row_no += 1
+            yield row_no, line
+            continue
+        if not line.strip():
+            continue
+        if is_csv:
+            values = next(csv.reader([line]))
+            if columns is None:
+                # Dòng đầu là header nếu có cột roomId, không thì dùng thứ tự mặc định
+                if "roomId" in values:
+                    columns = [value.strip() for value in values]
+                    continue
+                columns = CSV_COLUMNS
+            row_no += 1
+            yield row_no, {col: val.strip() or None for col, val in zip(columns, values)}
+        else:
+            row_no += 1
+            try:
+                yield row_no, json.loads(line)
+            except json.JSONDecodeError as e:
+                yield row_no, ValueError(f"JSON không hợp lệ: {e}")
+
+# API tạo nhiều thiết bị cùng lúc từ NDJSON (mặc định) hoặc CSV (Content-Type: text/csv)
+# Mỗi dòng: roomId, name, serialNo, bleMac
+@router.post("/bulk", status_code=status.HTTP_201_CREATED)
+async def bulk_create_devices(request: Request):
+    rows = []
+    errors = []
+
+    async for row_no, raw in iter_rows(request):
+        if isinstance(raw, Exception):
+            errors.append({"row": row_no, "error": str(raw)})
+            continue
+        try:
+            row = DeviceProvisionRow.model_validate(raw)
+        except ValidationError as e:
+            errors.append({"row": row_no, "error": "; ".join(
+                f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()
+            )})
+            continue
+        if not ObjectId.is_valid(row.roomId):
+            errors.append({"row": row_no, "error": f"roomId không hợp lệ: '{row.roomId}'"})
+            continue
+        rows.append((row_no, row))
+
+    # Kiểm tra tất cả phòng bằng một truy vấn $in
+    room_ids = {row.roomId for _, row in rows}
+    rooms = await db.rooms.find(
+        {"_id": {"$in": [ObjectId(room_id) for room_id in room_ids]}},
+        {"_id": 1}
+    ).to_list(length=None)
+    existing_rooms = {str(room["_id"]) for room in rooms}
+
+    # Template document dựng một lần cho cả request
+    now = datetime.now()
+    template = Device(roomId="", name="", createdAt=now).model_dump(by_alias=True, exclude=DEVICE_STATE_FIELDS)
+
+    pending = []
+    for row_no, row in rows:
+        if row.roomId not in existing_rooms:
+            errors.append({"row": row_no, "error": "Phòng không tồn tại"})
+            continue
+        device_doc = {
+            **template,
+            "_id": ObjectId(),
+            "roomId": row.roomId,
+            "name": row.name,
+            "serialNo": row.serialNo,
+            "bleMac": row.bleMac,
+            "endpoints": [dict(ep) for ep in DEFAULT_ENDPOINTS]
+        }
+        pending.append((row_no, device_doc))
+
+    created = []
+    for start in range(0, len(pending), BULK_BATCH_SIZE):
+        batch = pending[start:start + BULK_BATCH_SIZE]
+        failed_index = set()
+        try:
+            await db.devices.insert_many([doc for _, doc in batch], ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get("writeErrors", []):
+                failed_index.add(write_error["index"])
+                errors.append({"row": batch[write_error["index"]][0], "error": write_error.get("errmsg")})
+
+        inserted = [(row_no, doc) for i, (row_no, doc) in enumerate(batch) if i not in failed_index]
+        if not inserted:
+            continue
+        failed_index = set()
+        try:
+            await db.device_states.insert_many(
+                [new_state(doc["_id"], doc["roomId"], now) for _, doc in inserted],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            for write_error in e.details.get("writeErrors", []):
+                failed_index.add(write_error["index"])
+                errors.append({"row": inserted[write_error["index"]][0], "error": write_error.get("errmsg")})
+            # Không để lại device thiếu state: xóa các device tương ứng
+            await db.devices.delete_many({"_id": {"$in": [inserted[i][1]["_id"] for i in failed_index]}})
+        created.extend(
+            {"row": row_no, "deviceId": str(doc["_id"])}
+            for i, (row_no, doc) in enumerate(inserted) if i not in failed_index
+        )
+
+    if created:
+        get_read_coalescer().invalidate()
+
+    errors.sort(key=lambda err: err["row"])
+    return {
+        "message": f"Đã tạo {len(created)} thiết bị",
+        "created": len(created),
+        "failed": len(errors),
+        "devices": created,
+        "errors": errors
+    }
+
 # API cập nhật device
 @router.put("/{device_id}")
 async def update_device(
@@ -72,6 +253,13 @@ async def update_device(
         {"$set": update_data}
     )
 
+    if "roomId" in update_data:
+        await db.device_states.update_one(
+            {"_id": ObjectId(device_id)},
+            {"$set": {"roomId": update_data["roomId"]}}
+        )
+    get_read_coalescer().invalidate()
+
     return {"message": "Cập nhật thiết bị thành công"}
 
 # API xóa thiết bị
@@ -84,8 +272,10 @@ async def delete_device(device_id: str):
     # Xóa commands liên quan
     await db.commands.delete_many({"deviceId": device_id})
     
-    # Xóa thiết bị
+    # Xóa thiết bị và state
     await db.devices.delete_one({"_id": ObjectId(device_id)})
+    await db.device_states.delete_one({"_id": ObjectId(device_id)})
+    get_read_coalescer().invalidate()
 
     return None
 
@@ -111,15 +301,14 @@ async def add_endpoint(
     new_endpoint = DeviceEndpoint(
         id=endpoint_req.id,
         name=endpoint_req.name,
-        type=ep_type,
-        value=0,
-        lastUpdated=datetime.now()
+        type=ep_type
     )
 
     await db.devices.update_one(
         {"_id": ObjectId(device_id)},
-        {"$push": {"endpoints": new_endpoint.model_dump()}}
+        {"$push": {"endpoints": new_endpoint.model_dump(exclude=["value", "lastUpdated"])}}
     )
+    get_read_coalescer().invalidate()
 
     return {"message": "Đã thêm endpoint mới"}
 
@@ -147,6 +336,7 @@ async def update_endpoint(
         {"_id": ObjectId(device_id), "endpoints.id": endpoint_id},
         {"$set": update_fields}
     )
+    get_read_coalescer().invalidate()
 
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Endpoint không tìm thấy")
@@ -171,32 +361,43 @@ async def delete_endpoint(
         {"_id": ObjectId(device_id)},
         {"$pull": {"endpoints": {"id": endpoint_id}}}
     )
+    get_read_coalescer().invalidate()
 
     return {"message": "Đã xóa endpoint"}
 
 # API lấy danh sách thiết bị theo phòng
 @router.get("/room/{room_id}", response_model=List[Device])
 async def get_devices_by_room(room_id: str):
-    room = await db.rooms.find_one({"_id": ObjectId(room_id)})
-    if not room:
-        raise HTTPException(status_code=404, detail="Phòng không tồn tại")
+    async def load():
+        room = await db.rooms.find_one({"_id": ObjectId(room_id)})
+        if not room:
+            raise HTTPException(status_code=404, detail="Phòng không tồn tại")
+
+        devices = await db.devices.find({"roomId": room_id}).to_list(length=100)
+        devices = await attach_states(devices)
+        return DEVICE_LIST.dump_json(DEVICE_LIST.validate_python(devices), by_alias=True)
 
-    devices = await db.devices.find({"roomId": room_id}).to_list(length=100)
-    return devices
+    # Các request đồng thời dùng chung một truy vấn + một body JSON
+    return json_response(await get_read_coalescer().do(f"room-devices:{room_id}", load))
 
 # API lấy chi tiết device
 @router.get("/{device_id}", response_model=Device)
 async def get_device(device_id: str):
-    device = await db.devices.find_one({"_id": ObjectId(device_id)})
-    if not device:
-        raise HTTPException(status_code=404, detail="Thiết bị không tồn tại")
-    return device
+    async def load():
+        device = await db.devices.find_one({"_id": ObjectId(device_id)})
+        if not device:
+            raise HTTPException(status_code=404, detail="Thiết bị không tồn tại")
+        device = await attach_state(device)
+        return Device.model_validate(device).model_dump_json(by_alias=True).encode()
+
+    return json_response(await get_read_coalescer().do(f"device:{device_id}", load))
 
 # API gửi lệnh điều khiển endpoint qua MQTT
 @router.post("/{device_id}/command", status_code=status.HTTP_201_CREATED)
 async def send_command(
     device_id: str,
-    cmd_req: CommandRequest
+    cmd_req: CommandRequest,
+    request: Request
 ):
     # Validate endpoint ID
     if cmd_req.endpointId < 1 or cmd_req.endpointId > 3:
@@ -208,72 +409,25 @@ async def send_command(
     except Exception:
         raise HTTPException(status_code=400, detail=f"deviceId không hợp lệ: '{device_id}' (phải là 24 ký tự hex)")
 
-    device = await db.devices.find_one({"_id": device_obj_id})
+    # Chặn sớm client đã hết quota trước khi chạm tới DB (chưa trừ token)
+    limiter = get_command_limiter()
+    client = client_key(request)
+    limiter.check(client=client, consume=False)
+
+    device = await db.devices.find_one({"_id": device_obj_id}, {"roomId": 1})
     if not device:
         raise HTTPException(status_code=404, detail="Thiết bị không tồn tại")
 
-    new_command = Command(
-        commandId=str(ObjectId()),
-        deviceId=device_id,
-        endpointId=cmd_req.endpointId,
-        command=cmd_req.command,
-        payload=cmd_req.payload,
-        status="PENDING",
-        createdAt=datetime.now()
-    )
-
-    await db.commands.insert_one(new_command.model_dump(by_alias=True, exclude=["id"]))
-
-    room_id = device.get("roomId")
-    if not room_id:
-        raise HTTPException(status_code=400, detail="Thiết bị chưa được gán vào phòng")
+    # Trừ token client + thiết bị + phòng cùng lúc, chỉ khi thiết bị có thật và không bucket nào chặn
+    limiter.check(device_id=device_id, room_id=device.get("roomId"), client=client)
 
-    target_val = 1 if cmd_req.command == "TURN_ON" else 0
-
-    # === ĐẢM BẢO DEVICE CÓ currentLampStates (khởi tạo nếu chưa có) ===
-    if "currentLampStates" not in device or device.get("currentLampStates") is None:
-        await db.devices.update_one(
-            {"_id": device_obj_id},
-            {"$set": {"currentLampStates": {"device1": 0, "device2": 0, "device3": 0}}}
-        )
-
-    # === CẬP NHẬT DATABASE: endpoints + currentLampStates ===
-    await db.devices.update_one(
-        {"_id": device_obj_id, "endpoints.id": cmd_req.endpointId},
-        {"$set": {
-            "endpoints.$.value": target_val,
-            "endpoints.$.lastUpdated": datetime.now(),
-            f"currentLampStates.device{cmd_req.endpointId}": target_val
-        }}
-    )
-
-    # === LẤY TRẠNG THÁI MỚI TỪ currentLampStates (ƯU TIÊN) ===
-    updated_device = await db.devices.find_one({"_id": device_obj_id})
-    lamp_states = updated_device.get("currentLampStates", {})
-
-    payload = {
-        "device1": lamp_states.get("device1", 0),
-        "device2": lamp_states.get("device2", 0),
-        "device3": lamp_states.get("device3", 0),
-    }
-
-    topic = f"{room_id}/device"
-    payload_json = json.dumps(payload)
-    
-    # Kiểm tra MQTT connection
-    if not mqtt.client or not mqtt.client.is_connected:
-        print("[ERROR] MQTT client not connected!")
-        raise HTTPException(status_code=503, detail="MQTT broker không kết nối")
-    
-    # Publish với QoS=1 để đảm bảo ESP nhận được
-    mqtt.publish(topic, payload_json, qos=1)
-    print(f"[DEVICE CMD] Published to {topic}: {payload_json}")
+    result = await send_lamp_command(device, [cmd_req.endpointId], cmd_req.command, cmd_req.payload, source="DEVICE CMD")
 
     return {
         "message": "Đã gửi lệnh xuống thiết bị",
-        "commandId": new_command.commandId,
-        "mqtt_topic": topic,
-        "payload": payload
+        "commandId": result["commandIds"][0],
+        "mqtt_topic": result["mqtt_topic"],
+        "payload": result["payload"]
     }
 
 # API lấy lịch sử lệnh của device
@@ -4,9 +4,13 @@ from database import db
 from models import Room, RoomCreateRequest, RoomUpdateRequest
 from datetime import datetime
 from bson import ObjectId
+from pydantic import TypeAdapter
+from singleflight import get_read_coalescer, json_response
 
 router = APIRouter()
 
+ROOM_LIST = TypeAdapter(List[Room])
+
 # API tạo phòng mới
 @router.post("/", status_code=status.HTTP_201_CREATED)
 async def create_room(room_req: RoomCreateRequest):
@@ -17,6 +21,7 @@ async def create_room(room_req: RoomCreateRequest):
     )
 
     result = await db.rooms.insert_one(new_room.model_dump(by_alias=True, exclude=["id"]))
+    get_read_coalescer().invalidate()
 
     return {
         "message": "Tạo phòng thành công", 
@@ -26,9 +31,13 @@ async def create_room(room_req: RoomCreateRequest):
 # API lấy danh sách tất cả phòng
 @router.get("/", response_model=List[Room])
 async def get_all_rooms():
-    rooms_cursor = db.rooms.find({})
-    rooms = await rooms_cursor.to_list(length=100)
-    return rooms
+    async def load():
+        rooms_cursor = db.rooms.find({})
+        rooms = await rooms_cursor.to_list(length=100)
+        return ROOM_LIST.dump_json(ROOM_LIST.validate_python(rooms), by_alias=True)
+
+    # Các request đồng thời dùng chung một truy vấn + một body JSON
+    return json_response(await get_read_coalescer().do("rooms", load))
 
 # API lấy chi tiết phòng
 @router.get("/{room_id}", response_model=Room)
@@ -61,6 +70,7 @@ async def update_room(
         {"_id": ObjectId(room_id)},
         {"$set": update_data}
     )
+    get_read_coalescer().invalidate()
 
     return {"message": "Cập nhật phòng thành công"}
 
@@ -71,10 +81,12 @@ async def delete_room(room_id: str):
     if not room:
         raise HTTPException(status_code=404, detail="Phòng không tồn tại")
 
-    # Xóa tất cả device trong phòng
+    # Xóa tất cả device (và state) trong phòng
     await db.devices.delete_many({"roomId": room_id})
+    await db.device_states.delete_many({"roomId": room_id})
     
     # Xóa phòng
     await db.rooms.delete_one({"_id": ObjectId(room_id)})
+    get_read_coalescer().invalidate()
 
     return None
\ No newline at end of file
@@ -0,0 +1,72 @@
+from fastapi import APIRouter, HTTPException, status
+from typing import List
+from database import db
+from models import Rule, RuleCreateRequest, RuleUpdateRequest
+from datetime import datetime
+from bson import ObjectId
+from automation import rule_engine, compile_rule
+
+router = APIRouter()
+
+# API tạo rule tự động hóa
+@router.post("/", status_code=status.HTTP_201_CREATED)
+async def create_rule(rule_req: RuleCreateRequest):
+    new_rule = Rule(
+        name=rule_req.name,
+        roomId=rule_req.roomId,
+        trigger=rule_req.trigger,
+        action=rule_req.action,
+        enabled=rule_req.enabled,
+        createdAt=datetime.now()
+    )
+    rule_doc = new_rule.model_dump(by_alias=True, exclude=["id"])
+
+    try:
+        compile_rule(rule_doc)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    result = await db.rules.insert_one(rule_doc)
+    await rule_engine.reload()
+
+    return {
+        "message": "Tạo rule thành công",
+        "ruleId": str(result.inserted_id)
+    }
+
+# API lấy danh sách rule
+@router.get("/", response_model=List[Rule])
+async def get_all_rules(limit: int = 100, skip: int = 0):
+    rules = await db.rules.find({}).skip(skip).limit(limit).to_list(length=limit)
+    return rules
+
+# API xem số liệu của rule engine
+@router.get("/metrics")
+async def get_rule_metrics():
+    return rule_engine.metrics()
+
+# API bật/tắt rule
+@router.put("/{rule_id}")
+async def update_rule(rule_id: str, req: RuleUpdateRequest):
+    if req.enabled is None:
+        return {"message": "Không có thông tin nào thay đổi"}
+
+    result = await db.rules.update_one(
+        {"_id": ObjectId(rule_id)},
+        {"$set": {"enabled": req.enabled}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Rule không tồn tại")
+
+    await rule_engine.reload()
+    return {"message": "Cập nhật rule thành công"}
+
+# API xóa rule
+@router.delete("/{rule_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_rule(rule_id: str):
+    result = await db.rules.delete_one({"_id": ObjectId(rule_id)})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Rule không tồn tại")
+
+    await rule_engine.reload()
+    return None
@@ -0,0 +1,83 @@
+import asyncio
+import time
+from fastapi import Response
+from config import get_settings
+
+# Gộp các request đọc giống nhau đang chạy đồng thời thành một truy vấn DB duy nhất.
+# Kết quả (body JSON đã serialize) được giữ thêm `ttl` giây để hấp thụ các đợt dồn dập.
+class SingleFlight:
+    def __init__(self, ttl: float, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.misses = 0
+        self.shared = 0
+        self.cache_hits = 0
+        self._calls = {}
+        self._cache = {}
+
+    async def do(self, key, fn):
+        if self.ttl:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                self.cache_hits += 1
+                return cached[1]
+
+        task = self._calls.get(key)
+        if task is None:
+            self.misses += 1
+            # Chạy trong task riêng để request đầu bị hủy không làm hỏng các request đang chờ
+            task = asyncio.create_task(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.shared += 1
+
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        # Task bị invalidate gỡ khỏi _calls trong lúc chạy -> kết quả có thể đã cũ, không cache
+        current = self._calls.get(key) is task
+        if current:
+            del self._calls[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        if self.ttl and current:
+            if len(self._cache) >= self.max_entries:
+                self._prune()
+            self._cache[key] = (time.monotonic() + self.ttl, task.result())
+
+    def _prune(self):
+        now = time.monotonic()
+        self._cache = {key: entry for key, entry in self._cache.items() if entry[0] > now}
+
+    # Gọi sau mỗi thao tác ghi: request sau đó sẽ đọc lại từ DB.
+    # Truyền key để chỉ bỏ các kết quả bị ảnh hưởng, không truyền = bỏ tất cả
+    def invalidate(self, *keys):
+        if not keys:
+            self._calls.clear()
+            self._cache.clear()
+            return
+        for key in keys:
+            self._calls.pop(key, None)
+            self._cache.pop(key, None)
+
+    def metrics(self):
+        return {
+            "ttl_ms": self.ttl * 1000,
+            "misses": self.misses,
+            "shared": self.shared,
+            "cache_hits": self.cache_hits,
+            "in_flight": len(self._calls),
+            "cached": len(self._cache)
+        }
+
+_read_coalescer = None
+
+def get_read_coalescer() -> SingleFlight:
+    global _read_coalescer
+    if _read_coalescer is None:
+        _read_coalescer = SingleFlight(get_settings().read_cache_ttl_ms / 1000)
+    return _read_coalescer
+
+def json_response(body: bytes) -> Response:
+    return Response(content=body, media_type="application/json")
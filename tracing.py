@@ -0,0 +1,149 @@
+import itertools
+import threading
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime
+from pymongo import monitoring
+from config import get_settings
+
+# Mã tương quan của request HTTP / message MQTT đang xử lý.
+# Motor chạy lệnh pymongo trong thread pool nhưng có copy context nên listener đọc được.
+correlation_id: ContextVar = ContextVar("correlation_id", default=None)
+
+_mqtt_seq = itertools.count(1)
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+def new_message_id() -> str:
+    return f"mqtt-{next(_mqtt_seq)}"
+
+# Vị trí filter trong từng loại lệnh
+def _extract_filter(command_name: str, command: dict):
+    if command_name in ("find", "count", "distinct"):
+        return command.get("filter", command.get("query"))
+    if command_name == "findAndModify":
+        return command.get("query")
+    if command_name == "update":
+        updates = command.get("updates") or [{}]
+        return updates[0].get("q")
+    if command_name == "delete":
+        deletes = command.get("deletes") or [{}]
+        return deletes[0].get("q")
+    if command_name == "aggregate":
+        for stage in command.get("pipeline", []):
+            if "$match" in stage:
+                return stage["$match"]
+    return None
+
+# Giữ lại key/operator, thay giá trị bằng "?" để không log dữ liệu thật
+def filter_shape(value, depth: int = 0):
+    if depth > 5:
+        return "..."
+    if isinstance(value, dict):
+        return {key: filter_shape(val, depth + 1) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [filter_shape(value[0], depth + 1)] if value else []
+    return "?"
+
+class SlowOpTracer(monitoring.CommandListener):
+    def __init__(self, threshold_ms: float, buffer_size: int = 1000):
+        self.threshold_us = threshold_ms * 1000
+        self.ops = 0
+        self.slow_ops = 0
+        # (collection, lệnh) -> [số lần, tổng micro giây, max micro giây]
+        self.stats = {}
+        self._pending = {}
+        self._slow = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+
+    # Lấy correlation id ngay khi lệnh bắt đầu (cùng thread + context với lời gọi Motor)
+    def started(self, event):
+        self._pending[(event.connection_id, event.request_id)] = (event.command, correlation_id.get())
+
+    def succeeded(self, event):
+        self._finish(event, None)
+
+    def failed(self, event):
+        self._finish(event, str(event.failure.get("errmsg", event.failure)))
+
+    def _finish(self, event, error):
+        command, request_id = self._pending.pop((event.connection_id, event.request_id), (None, None))
+        duration_us = event.duration_micros
+        collection = command.get(event.command_name) if command else None
+        if not isinstance(collection, str):
+            collection = None
+
+        key = (collection, event.command_name)
+        with self._lock:
+            self.ops += 1
+            stat = self.stats.get(key)
+            if stat is None:
+                self.stats[key] = [1, duration_us, duration_us]
+            else:
+                stat[0] += 1
+                stat[1] += duration_us
+                if duration_us > stat[2]:
+                    stat[2] = duration_us
+
+        if duration_us < self.threshold_us:
+            return
+
+        # Nhánh chậm: chỉ ở đây mới dựng filter shape
+        entry = {
+            "at": datetime.now().isoformat(),
+            "ts": time.time(),
+            "duration_ms": round(duration_us / 1000, 2),
+            "command": event.command_name,
+            "collection": collection,
+            "database": event.database_name,
+            "correlationId": request_id,
+            "filter": filter_shape(_extract_filter(event.command_name, command or {})),
+            "error": error
+        }
+        with self._lock:
+            self.slow_ops += 1
+            self._slow.append(entry)
+        print(
+            f"[SLOW DB] {entry['duration_ms']}ms {entry['command']} {collection} "
+            f"id={entry['correlationId']} filter={entry['filter']}"
+        )
+
+    # Top-N lệnh chậm nhất trong cửa sổ thời gian gần đây
+    def top(self, limit: int = 20, window_s: float = 600):
+        since = time.time() - window_s
+        with self._lock:
+            entries = [entry for entry in self._slow if entry["ts"] >= since]
+        entries.sort(key=lambda entry: entry["duration_ms"], reverse=True)
+        return [{k: v for k, v in entry.items() if k != "ts"} for entry in entries[:limit]]
+
+    def summary(self):
+        with self._lock:
+            stats = [
+                {
+                    "collection": collection,
+                    "command": command_name,
+                    "count": count,
+                    "avg_ms": round(total / count / 1000, 3),
+                    "max_ms": round(max_us / 1000, 3)
+                }
+                for (collection, command_name), (count, total, max_us) in self.stats.items()
+            ]
+        stats.sort(key=lambda stat: stat["count"], reverse=True)
+        return {
+            "ops": self.ops,
+            "slow_ops": self.slow_ops,
+            "threshold_ms": self.threshold_us / 1000,
+            "by_command": stats
+        }
+
+_tracer = None
+
+def get_tracer() -> SlowOpTracer:
+    global _tracer
+    if _tracer is None:
+        settings = get_settings()
+        _tracer = SlowOpTracer(settings.slow_op_ms, settings.slow_op_buffer)
+    return _tracer